@@ -0,0 +1,57 @@
+# --- Benchmark: procesado completo en memoria frente a procesado por bloques (pico de RSS y tiempo) ---
+# Uso: python benchmarks/bench_bloques.py [n_filas] [tamaño_bloque ...]
+# Cada variante se ejecuta en un proceso nuevo para que el pico de RSS (VmHWM) sea sólo el suyo.
+import os, sys, time, resource, tempfile, multiprocessing
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pandas as pd
+from datos_sinteticos import generar_extracto
+
+ph_cat, ph_sub = 'SIN CATEGORÍA', 'SIN SUBCATEGORÍA'
+
+def _rss_mb():
+    # VmHWM se reinicia con exec(); ru_maxrss en Linux hereda el pico del proceso padre
+    try:
+        with open('/proc/self/status') as f: return next(int(l.split()[1]) for l in f if l.startswith('VmHWM')) / 1024
+    except (OSError, StopIteration): return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def en_memoria(csv_path, out_path):
+    # Mismo recorrido que main() y la línea de comandos: cargar todo, normalizar, aprender, sugerir y exportar
+    import gastos_familiares_core as core
+    base = _rss_mb(); t0 = time.perf_counter()
+    df, _ = core.normalize_transactions(core.read_bank_csv(csv_path))
+    core.categorize_frame(df)
+    core.write_output(df, out_path, 'csv')
+    return base, _rss_mb(), time.perf_counter() - t0
+
+def por_bloques(csv_path, out_path, chunksize):
+    import gastos_familiares_core as core
+    base = _rss_mb(); t0 = time.perf_counter()
+    core.process_csv_stream(csv_path, out_path, chunksize=chunksize)
+    return base, _rss_mb(), time.perf_counter() - t0
+
+def _hijo(fn, args, queue): queue.put(fn(*args))
+
+def ejecutar(fn, *args):
+    # Misma semilla de hash en todos los hijos: la subcategoría por defecto de un comercio sale de iterar un set
+    os.environ['PYTHONHASHSEED'] = '0'
+    ctx = multiprocessing.get_context('spawn'); queue = ctx.Queue()
+    p = ctx.Process(target=_hijo, args=(fn, args, queue)); p.start(); res = queue.get(); p.join()
+    return res
+
+def main(n, chunk_sizes):
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = os.path.join(tmp, 'extracto.csv')
+        generar_extracto(n, seed=4).to_csv(csv_path, index=False, sep=';')
+        print(f"{n} filas, CSV de {os.path.getsize(csv_path) / 2**20:.1f} MB")
+        ref_path = os.path.join(tmp, 'ref.csv'); base, peak, t = ejecutar(en_memoria, csv_path, ref_path)
+        print(f"  en memoria          | pico RSS +{peak - base:7.1f} MB | {t:6.2f} s")
+        ref = pd.read_csv(ref_path, sep=';', dtype=str)
+        for chunksize in chunk_sizes:
+            out_path = os.path.join(tmp, f'bloques_{chunksize}.csv'); base, peak, t = ejecutar(por_bloques, csv_path, out_path, chunksize)
+            out = pd.read_csv(out_path, sep=';', dtype=str)
+            pd.testing.assert_frame_equal(out, ref)
+            print(f"  bloques de {chunksize:>8} | pico RSS +{peak - base:7.1f} MB | {t:6.2f} s")
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:]]
+    main(args[0] if args else 1_000_000, args[1:] or [20_000, 100_000])
@@ -0,0 +1,26 @@
+# --- Benchmark: búsqueda en CONCEPTO con str.contains frente al índice de trigramas, y tamaño de la página enviada ---
+# Uso: python benchmarks/bench_busqueda.py [n_filas ...]
+import os, sys, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy as np
+import gastos_familiares_core as core
+from datos_sinteticos import generar_procesado
+
+CONSULTAS = ["mercadona", "Netflix", "1042", "ta", "repsol estacion", "tarj.", "no existe"]
+
+def main(sizes, page_size=100):
+    for n in sizes:
+        df = generar_procesado(n, categorical=True)
+        t0 = time.perf_counter(); index = core.ConceptoSearchIndex(df['CONCEPTO']); t_build = time.perf_counter() - t0
+        t_scan = t_index = 0.0
+        for q in CONSULTAS:
+            t0 = time.perf_counter(); ref = df['CONCEPTO'].str.contains(q, case=False, na=False, regex=False).to_numpy(); t_scan += time.perf_counter() - t0
+            t0 = time.perf_counter(); got = index.search(q); t_index += time.perf_counter() - t0
+            assert np.array_equal(ref, got), q
+        positions = core.sorted_positions(df, np.ones(len(df), dtype=bool), 'Fecha', False)
+        pagina = df.iloc[positions[:page_size]]
+        print(f"{n:>8} filas | índice {len(index.lower):>6} conceptos, {t_build:6.3f} s | str.contains {t_scan / len(CONSULTAS) * 1e3:7.2f} ms | índice {t_index / len(CONSULTAS) * 1e3:6.2f} ms"
+              f" | página {pagina.memory_usage(deep=True).sum() / 1024:6.1f} KB de {df.memory_usage(deep=True).sum() / 2**20:6.1f} MB")
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or [10_000, 100_000, 500_000])
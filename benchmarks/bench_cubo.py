@@ -0,0 +1,44 @@
+# --- Benchmark: informes de Gastos y P&L sobre las transacciones frente al cubo de agregados ---
+# Uso: python benchmarks/bench_cubo.py [n_filas ...]
+import os, sys, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy as np
+import pandas as pd
+import gastos_familiares_core as core
+from datos_sinteticos import generar_procesado, CUENTAS
+
+tipo, cat, subcat, ano, mes, cta, imp = 'TIPO', 'CATEGORÍA', 'SUBCATEGORIA', 'Año', 'Mes', 'CUENTA', 'importe'
+FILTROS = [(año, ctas) for año in range(2019, 2025) for ctas in (CUENTAS, CUENTAS[:2], ['EVO'])]
+
+def informes_transacciones(df, año, ctas):
+    df_g = df[df[tipo].isin(['GASTO']) & (df[ano] == año) & df[cta].isin(ctas)]
+    piv = df_g.pivot_table(values=imp, index=cat, columns=mes, aggfunc='sum', fill_value=0, margins=True, margins_name='Total', observed=True)
+    df_evo = df[(df[cta] == 'EVO') & (df[ano] == año)]
+    return piv, df_evo[df_evo[tipo].isin(['TRASPASO', 'INGRESO', 'REEMBOLSO'])].groupby(mes)[imp].sum()
+
+def informes_cubo(cube, año, ctas):
+    cube_g = core.filter_cube(cube, TIPO=['GASTO'], Año=año, CUENTA=ctas)
+    piv = cube_g.pivot_table(values=imp, index=cat, columns=mes, aggfunc='sum', fill_value=0, margins=True, margins_name='Total')
+    return piv, core.filter_cube(cube, CUENTA='EVO', Año=año, TIPO=['TRASPASO', 'INGRESO', 'REEMBOLSO']).groupby(mes)[imp].sum()
+
+def main(sizes):
+    for n in sizes:
+        df = generar_procesado(n, categorical=True)
+        t0 = time.perf_counter(); cube = core.build_aggregate_cube(df); t_build = time.perf_counter() - t0
+        t0 = time.perf_counter(); ref = [informes_transacciones(df, *f) for f in FILTROS]; t_df = (time.perf_counter() - t0) / len(FILTROS)
+        t0 = time.perf_counter(); res = [informes_cubo(cube, *f) for f in FILTROS]; t_cube = (time.perf_counter() - t0) / len(FILTROS)
+        for (piv_a, ing_a), (piv_b, ing_b) in zip(ref, res):
+            piv_a.index = piv_a.index.astype(object)
+            pd.testing.assert_frame_equal(piv_a, piv_b, check_names=False, check_dtype=False)
+            pd.testing.assert_series_equal(ing_a, ing_b, check_names=False, check_dtype=False)
+        # La actualización incremental tras editar filas debe coincidir con reconstruir el cubo
+        rng = np.random.default_rng(0); idx = df.index[rng.choice(len(df), min(500, len(df)), replace=False)]
+        old_rows = df.loc[idx]; new_rows = old_rows.assign(**{cat: 'EDITADA', subcat: 'EDITADA'})
+        t0 = time.perf_counter(); updated = core.update_aggregate_cube(cube, old_rows, new_rows); t_update = time.perf_counter() - t0
+        df_edit = df.copy(); core.assign_values(df_edit, idx, cat, 'EDITADA'); core.assign_values(df_edit, idx, subcat, 'EDITADA')
+        key = lambda c: c.sort_values(core.CUBE_DIMS).reset_index(drop=True)
+        pd.testing.assert_frame_equal(key(updated), key(core.build_aggregate_cube(df_edit)), check_dtype=False)
+        print(f"{n:>8} filas | cubo {len(cube):>6} celdas, {t_build:6.3f} s | informe transacciones {t_df * 1e3:7.1f} ms | cubo {t_cube * 1e3:6.1f} ms | actualización {t_update * 1e3:5.1f} ms")
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or [10_000, 100_000, 500_000])
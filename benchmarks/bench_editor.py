@@ -0,0 +1,48 @@
+# --- Benchmark: "Aplicar Cambios Editados" reescribiendo toda la vista frente a aplicar sólo las celdas editadas ---
+# Uso: python benchmarks/bench_editor.py [n_filas] [filas_en_vista ...]
+import os, sys, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy as np
+import pandas as pd
+import gastos_familiares_core as core
+from datos_sinteticos import generar_procesado
+
+cat, subcat, desc, imp = 'CATEGORÍA', 'SUBCATEGORIA', 'CONCEPTO', 'importe'
+ph_cat, ph_sub = 'SIN CATEGORÍA', 'SIN SUBCATEGORÍA'
+N_EDICIONES = 5
+
+def aplicar_vista_completa(df, cube, edited_data, hierarchy):
+    # Réplica del botón anterior: valida fila a fila toda la vista y la reescribe entera
+    indices = edited_data['original_index']; old_rows = df.loc[indices]
+    new_rows = old_rows.assign(**{c: edited_data[c].to_numpy(dtype=object) for c in (cat, subcat)})
+    invalid = [idx for idx, c, s in zip(new_rows.index, new_rows[cat], new_rows[subcat]) if c in hierarchy and s not in hierarchy[c] and s != ph_sub and s != '']
+    assert not invalid
+    for c in (cat, subcat): core.assign_values(df, indices, c, new_rows[c].to_numpy(dtype=object))
+    return core.update_aggregate_cube(cube, old_rows, new_rows), len(indices)
+
+def aplicar_diferencias(df, cube, view_index, edited_rows, hierarchy):
+    old_rows, new_rows = core.diff_edited_rows(df, view_index, edited_rows, [cat, subcat])
+    assert not core.invalid_category_mask(new_rows, cat, subcat, hierarchy, ph_sub).any()
+    n = core.apply_row_edits(df, new_rows, [cat, subcat])
+    return core.update_aggregate_cube(cube, old_rows, new_rows), n
+
+def main(n, view_sizes):
+    base = generar_procesado(n, categorical=True)
+    hierarchy = core.derive_category_hierarchy(base, cat, subcat, ph_cat, ph_sub); cube = core.build_aggregate_cube(base)
+    cat_ok = sorted(hierarchy)[0]; sub_ok = sorted(hierarchy[cat_ok])[0]
+    for size in view_sizes:
+        view = base.iloc[:size].assign(original_index=base.index[:size])
+        edited_rows = {int(p): {cat: cat_ok, subcat: sub_ok} for p in np.linspace(0, size - 1, N_EDICIONES).astype(int)}
+        edited_data = view.copy()
+        for p, changes in edited_rows.items():
+            for c, v in changes.items(): edited_data.iloc[p, edited_data.columns.get_loc(c)] = v
+        df_a = base.copy(); t0 = time.perf_counter(); cube_a, n_a = aplicar_vista_completa(df_a, cube, edited_data, hierarchy); t_a = time.perf_counter() - t0
+        df_b = base.copy(); t0 = time.perf_counter(); cube_b, n_b = aplicar_diferencias(df_b, cube, view.index, edited_rows, hierarchy); t_b = time.perf_counter() - t0
+        pd.testing.assert_frame_equal(df_a, df_b)
+        key = lambda c: c.sort_values(core.CUBE_DIMS).reset_index(drop=True)
+        pd.testing.assert_frame_equal(key(cube_a), key(cube_b), check_dtype=False)
+        print(f"{size:>7} filas en vista | {N_EDICIONES} editadas | vista completa {t_a * 1e3:8.1f} ms ({n_a} 'cambios') | diferencias {t_b * 1e3:7.1f} ms ({n_b} cambios)")
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:]]
+    main(args[0] if args else 200_000, args[1:] or [100, 500, 5_000, 50_000])
@@ -0,0 +1,46 @@
+# --- Benchmark: tiempo, filas y pico de memoria de cada etapa del recorrido de la app, sin Streamlit ---
+# Uso: python benchmarks/bench_etapas.py [--memoria] [--json RUTA] [n_filas ...]
+# Extractos sintéticos con el esquema del CSV del banco; mide carga en frío, lectura de caché, categorización,
+# pivote de Gastos, serialización de una página del editor (Arrow, como hace st.data_editor) y exportación.
+import os, sys, tempfile, argparse
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pandas as pd
+import pyarrow as pa
+import gastos_familiares_core as core
+from datos_sinteticos import generar_extracto
+
+PAGE_SIZE = 100 # Tamaño de página del editor de la app
+
+def recorrido(data, cache_dir):
+    df, _, _, _ = core.load_transactions(data, cache_dir) # lectura_csv, normalizacion, escritura_cache_parquet
+    core.load_transactions(data, cache_dir) # lectura_cache_parquet
+    result = core.categorize_frame(df) # aprendizaje, sugerencias, cubo_agregados
+    cube_g = core.filter_cube(result['cube'], TIPO=['GASTO'])
+    with core.stage('pivote_gastos', len(cube_g)): cube_g.pivot_table(values='importe', index='CATEGORÍA', columns='Mes', aggfunc='sum', fill_value=0, margins=True, margins_name='Total')
+    page = df.iloc[:PAGE_SIZE].assign(original_index=df.index[:PAGE_SIZE])
+    with core.stage('editor_pagina', len(page)):
+        table = pa.Table.from_pandas(page); sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer: writer.write_table(table)
+    for fmt in ('csv', 'csv.gz', 'parquet'): core.ExportCache().render(df, fmt) # exportacion_csv, exportacion_csv.gz, exportacion_parquet
+
+def main(sizes, track_memory=False, json_path=None):
+    profiler = core.Profiler(track_memory=track_memory)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for n in sizes:
+            data = generar_extracto(n, seed=7).to_csv(index=False, sep=';').encode('utf-8')
+            with profiler.activate(label=f'{n} filas'), core.stage('total', n): recorrido(data, cache_dir)
+            summary = profiler.last_run()
+            print(f"--- {n} filas ({len(data) / 1e6:.1f} MB de CSV) ---")
+            for r in summary.itertuples():
+                mem = f" | pico {r.peak_mb:8.1f} MB" if track_memory else ""
+                rows = f"{int(r.rows):>9}" if pd.notna(r.rows) else " " * 9
+                print(f"  {'  ' * r.depth}{r.stage:<{26 - 2 * r.depth}} {rows} filas | {r.seconds:7.3f} s{mem}")
+    if json_path:
+        with open(json_path, 'w', encoding='utf-8') as f: f.write(profiler.to_json())
+        print(f"Mediciones guardadas en {json_path}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sizes', nargs='*', type=int); parser.add_argument('--memoria', action='store_true'); parser.add_argument('--json')
+    args = parser.parse_args()
+    main(args.sizes or [10_000, 100_000, 1_000_000], args.memoria, args.json)
@@ -0,0 +1,36 @@
+# --- Benchmark: descarga CSV de la sesión (antiguo convert_df_to_csv) frente a la exportación por bloques con caché incremental ---
+# Uso: python benchmarks/bench_exportacion.py [n_filas ...]
+import os, sys, time, gzip
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy as np
+import pandas as pd
+import gastos_familiares_core as core
+from datos_sinteticos import generar_procesado
+
+N_EDICIONES = 20
+
+def convert_df_to_csv_anterior(df):
+    # Réplica del antiguo convert_df_to_csv (sin el hash de @st.cache_data, que además se pagaba en cada rerun)
+    d = df.rename(columns={'importe': 'IMPORTE'})
+    d['IMPORTE'] = pd.to_numeric(d['IMPORTE'], errors='coerce'); d['IMPORTE'] = d['IMPORTE'].map('{:.2f}'.format).str.replace('.', ',', regex=False).fillna('0,00')
+    return d.drop(columns=['original_index', 'temp_id'], errors='ignore').to_csv(index=False, sep=';', decimal=',').encode('utf-8')
+
+def main(sizes):
+    for n in sizes:
+        df = generar_procesado(n, categorical=True)
+        t0 = time.perf_counter(); ref = convert_df_to_csv_anterior(df); t_old = time.perf_counter() - t0
+        cache = core.ExportCache()
+        t0 = time.perf_counter(); data = cache.render(df, 'csv'); t_new = time.perf_counter() - t0
+        assert data == ref
+        t0 = time.perf_counter(); cache.render(df, 'csv'); t_hit = time.perf_counter() - t0
+        idx = df.index[np.random.default_rng(0).choice(len(df), N_EDICIONES, replace=False)]
+        core.assign_values(df, idx, 'CATEGORÍA', 'EDITADA'); cache.invalidate(df, idx)
+        t0 = time.perf_counter(); data = cache.render(df, 'csv'); t_inc = time.perf_counter() - t0
+        assert data == convert_df_to_csv_anterior(df)
+        t0 = time.perf_counter(); gz = core.ExportCache().render(df, 'csv.gz'); t_gz = time.perf_counter() - t0
+        assert gzip.decompress(gz) == data
+        print(f"{n:>8} filas | anterior {t_old:6.2f} s | bloques {t_new:6.2f} s | misma versión {t_hit * 1e3:5.1f} ms"
+              f" | tras {N_EDICIONES} ediciones {t_inc:6.2f} s | csv.gz {t_gz:6.2f} s ({len(gz) / len(data):.0%} del tamaño)")
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or [10_000, 100_000, 1_000_000])
@@ -0,0 +1,21 @@
+# --- Benchmark: carga del CSV (parseo + normalización) frente a lectura de la caché Parquet ---
+# Uso: python benchmarks/bench_ingesta.py [n_filas ...]
+import os, sys, time, tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pandas as pd
+import gastos_familiares_core as core
+from datos_sinteticos import generar_extracto
+
+def main(sizes):
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for n in sizes:
+            data = generar_extracto(n, seed=2).to_csv(index=False, sep=';').encode('utf-8')
+            t0 = time.perf_counter(); df_csv, _, from_cache, _ = core.load_transactions(data, cache_dir); t_csv = time.perf_counter() - t0
+            assert not from_cache
+            t0 = time.perf_counter(); df_cache, _, from_cache, _ = core.load_transactions(data, cache_dir); t_cache = time.perf_counter() - t0
+            assert from_cache
+            pd.testing.assert_frame_equal(df_csv, df_cache)
+            print(f"{n:>9} filas | CSV {len(data) / 1e6:7.1f} MB {t_csv:7.3f} s | caché Parquet {t_cache:7.3f} s | x{t_csv / max(t_cache, 1e-9):6.1f}")
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or [10_000, 100_000, 1_000_000])
@@ -0,0 +1,50 @@
+# --- Benchmark: pico de memoria de una interacción (rerun con "Sugerir CATEGORÍAS") con y sin copias del DataFrame ---
+# Uso: python benchmarks/bench_memoria.py [n_filas ...]
+# El pico se mide con tracemalloc (numpy y pandas registran sus buffers), que a diferencia de ru_maxrss se puede reiniciar entre interacciones.
+import os, sys, tracemalloc
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pandas as pd
+import gastos_familiares_core as core
+from datos_sinteticos import generar_procesado
+
+tipo, cat, subcat, ano, desc, com, cta, imp = 'TIPO', 'CATEGORÍA', 'SUBCATEGORIA', 'Año', 'CONCEPTO', 'COMERCIO', 'CUENTA', 'importe'
+ph_cat, ph_sub = 'SIN CATEGORÍA', 'SIN SUBCATEGORÍA'
+
+def interaccion_con_copias(session):
+    # Patrón anterior de main(): copia defensiva en cada pestaña y en el botón, y otra al guardar el resultado
+    df = session['df'].copy()
+    df_g_tab = df[df[tipo].isin(['GASTO'])].copy(); df_g_a = df_g_tab[df_g_tab[ano] == 2020]; df_g_f = df_g_a[df_g_a[cta].isin(['EVO', 'BBVA'])].copy()
+    df_evo = df[df[cta] == 'EVO'].copy(); df_evo_a = df_evo[df_evo[ano] == 2020]
+    df_display_edit = session['df'].copy(); df_display_edit['original_index'] = df_display_edit.index
+    df_suggest = session['df'].copy()
+    core.apply_category_suggestions(df_suggest, desc, imp, cat, subcat, com, ph_cat, ph_sub, session['comercio_map'], session['hierarchy'])
+    session['df'] = df_suggest.copy()
+    return len(df_g_f) + len(df_evo_a) + len(df_display_edit)
+
+def interaccion_sin_copias(session):
+    df = session['df']
+    mask_g = df[tipo].isin(['GASTO']) & (df[ano] == 2020); df_g_f = core.select_rows(df, mask_g & df[cta].isin(['EVO', 'BBVA']))
+    df_evo_a = core.select_rows(df, (df[cta] == 'EVO') & (df[ano] == 2020))
+    df_display_edit = core.select_rows(df); df_display_edit = df_display_edit.assign(original_index=df_display_edit.index)
+    core.apply_category_suggestions(df, desc, imp, cat, subcat, com, ph_cat, ph_sub, session['comercio_map'], session['hierarchy'])
+    return len(df_g_f) + len(df_evo_a) + len(df_display_edit)
+
+def pico_mb(fn, session, copy_on_write):
+    with pd.option_context('mode.copy_on_write', copy_on_write):
+        tracemalloc.start(); tracemalloc.reset_peak(); base = tracemalloc.get_traced_memory()[0]
+        fn(session)
+        peak = tracemalloc.get_traced_memory()[1]; tracemalloc.stop()
+    return (peak - base) / 2**20
+
+def main(sizes):
+    for n in sizes:
+        df = generar_procesado(n, categorical=True)
+        hierarchy = core.derive_category_hierarchy(df, cat, subcat, ph_cat, ph_sub)
+        comercio_map = dict(list(core.derive_comercio_map(df, com, cat, ph_cat).items())[::2])
+        core.learn_categories(df, desc, cat, subcat, imp, ph_cat, ph_sub)
+        antes = pico_mb(interaccion_con_copias, {'df': df.copy(deep=True), 'comercio_map': comercio_map, 'hierarchy': hierarchy}, False)
+        despues = pico_mb(interaccion_sin_copias, {'df': df.copy(deep=True), 'comercio_map': comercio_map, 'hierarchy': hierarchy}, True)
+        print(f"{n:>8} filas | DataFrame {df.memory_usage(deep=True).sum() / 2**20:7.1f} MB | pico con copias {antes:8.1f} MB | sin copias {despues:8.1f} MB")
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or [10_000, 50_000, 200_000])
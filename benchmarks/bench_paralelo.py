@@ -0,0 +1,27 @@
+# --- Benchmark: escalado de la categorización con un pool de procesos (1, 2, 4 y 8 procesos) ---
+# Uso: python benchmarks/bench_paralelo.py [n_filas] [procesos ...]
+# Un extracto por CUENTA, como al importar un archivo por banco; cada variante carga en frío (caché vacía).
+import os, sys, time, tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pandas as pd
+import gastos_familiares_core as core
+from datos_sinteticos import generar_extracto
+
+def main(n, workers_list):
+    with tempfile.TemporaryDirectory() as tmp:
+        extracto = generar_extracto(n, seed=6); paths = []
+        for cuenta, parte in extracto.groupby('CUENTA', sort=True):
+            paths.append(os.path.join(tmp, f'{cuenta}.csv')); parte.to_csv(paths[-1], index=False, sep=';')
+        print(f"{n} filas en {len(paths)} archivos, {os.cpu_count()} núcleos")
+        ref = None; t_ref = None
+        for workers in workers_list:
+            cache_dir = tempfile.mkdtemp(dir=tmp)
+            t0 = time.perf_counter(); df, _, _ = core.load_files(paths, cache_dir, workers=workers); t_load = time.perf_counter() - t0
+            t0 = time.perf_counter(); result = core.categorize_frame(df, workers=workers); t_cat = time.perf_counter() - t0
+            if ref is None: ref = df; t_ref = t_load + t_cat
+            else: pd.testing.assert_frame_equal(df, ref)
+            print(f"  {workers} procesos | carga {t_load:6.2f} s | aprender+sugerir {t_cat:6.2f} s | sugerencias {result['suggestions']:>7} | x{t_ref / (t_load + t_cat):5.2f}")
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:]]
+    main(args[0] if args else 1_000_000, args[1:] or [1, 2, 4, 8])
@@ -0,0 +1,40 @@
+# --- Benchmark: bucle fila a fila de suggest_category vs. motor por lotes ---
+# Uso: python benchmarks/bench_sugerencias.py [n_filas ...]
+import os, sys, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pandas as pd
+import gastos_familiares_core as core
+from datos_sinteticos import generar_procesado
+
+cat, subcat, desc, com, imp = 'CATEGORÍA', 'SUBCATEGORIA', 'CONCEPTO', 'COMERCIO', 'importe'
+ph_cat, ph_sub = 'SIN CATEGORÍA', 'SIN SUBCATEGORÍA'
+
+def bucle_fila_a_fila(df, comercio_map, hierarchy):
+    # Réplica del antiguo bucle del botón "Sugerir CATEGORÍAS Faltantes"
+    applied = 0; rule_matcher = core.get_rule_matcher()
+    for index in df[df[cat] == ph_cat].index:
+        row = df.loc[index]; sugg = core.suggest_category(row, desc, imp, cat, subcat, com, comercio_map, hierarchy, rule_matcher)
+        applied_c = False
+        if sugg is not None:
+            sugg_cat, sugg_sub = sugg
+            if sugg_cat and df.loc[index, cat] == ph_cat: df.loc[index, cat] = sugg_cat; applied_c = True
+            if sugg_sub and df.loc[index, subcat] == ph_sub:
+                if applied_c or (sugg_cat is None and df.loc[index, cat] != ph_cat): df.loc[index, subcat] = sugg_sub; applied_c = True
+        if applied_c: applied += 1
+    return applied
+
+def main(sizes):
+    for n in sizes:
+        df = generar_procesado(n)
+        hierarchy = core.derive_category_hierarchy(df, cat, subcat, ph_cat, ph_sub)
+        # Mapa de comercios parcial para que todas las etapas de la precedencia intervengan
+        comercio_map = dict(list(core.derive_comercio_map(df, com, cat, ph_cat).items())[::2])
+        core.learn_categories(df, desc, cat, subcat, imp, ph_cat, ph_sub)
+        df_loop = df.copy(); t0 = time.perf_counter(); n_loop = bucle_fila_a_fila(df_loop, comercio_map, hierarchy); t_loop = time.perf_counter() - t0
+        df_batch = df.copy(); t0 = time.perf_counter(); n_batch = core.apply_category_suggestions(df_batch, desc, imp, cat, subcat, com, ph_cat, ph_sub, comercio_map, hierarchy); t_batch = time.perf_counter() - t0
+        assert n_loop == n_batch, (n_loop, n_batch)
+        pd.testing.assert_frame_equal(df_loop, df_batch)
+        print(f"{n:>8} filas | sugerencias {n_batch:>7} | bucle {t_loop:8.3f} s | lotes {t_batch:7.3f} s | x{t_loop / max(t_batch, 1e-9):6.1f}")
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or [1_000, 10_000, 50_000])
@@ -0,0 +1,43 @@
+# --- Benchmark: aprendizaje fila a fila frente a la tokenización por concepto distinto (con caché LRU fría y caliente) ---
+# Uso: python benchmarks/bench_tokens.py [n_filas ...]
+import os, sys, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from collections import Counter
+import gastos_familiares_core as core
+from datos_sinteticos import generar_procesado
+
+cat, subcat, desc, imp = 'CATEGORÍA', 'SUBCATEGORIA', 'CONCEPTO', 'importe'
+ph_cat, ph_sub = 'SIN CATEGORÍA', 'SIN SUBCATEGORÍA'
+
+def aprender_fila_a_fila(df):
+    # Réplica del antiguo update_category_knowledge: clean_text_series y split() - keywords_to_ignore en cada fila
+    knowledge = core.new_category_knowledge(); kw_counter = knowledge["kw_counter"]; amt_counter = knowledge["amt_counter"]
+    df = df[core.learnable_mask(df, cat, subcat, ph_cat, ph_sub)]
+    cleaned = core.clean_text_series(df[desc]); bins = core.amount_bin_series(df[imp]).tolist()
+    for text, amt_bin, c, s in zip(cleaned, bins, df[cat], df[subcat]):
+        for w in set(text.split()) - core.keywords_to_ignore:
+            if len(w) < 4: continue
+            kw_counter.setdefault(w, Counter())[(c, s)] += 1; amt_counter.setdefault((w, amt_bin), Counter())[(c, s)] += 1
+    core._refresh_argmax(kw_counter, knowledge["keyword_map"], list(kw_counter)); core._refresh_argmax(amt_counter, knowledge["amount_map"], list(amt_counter))
+    return knowledge
+
+def aprender(df):
+    knowledge = core.new_category_knowledge(); core.learn_categories(df, desc, cat, subcat, imp, ph_cat, ph_sub, knowledge); return knowledge
+
+def iguales(a, b):
+    # Mismos argmax y mismas etiquetas en el mismo orden (el orden decide los empates de most_common)
+    return all(a[k] == b[k] for k in ('keyword_map', 'amount_map')) and all(
+        list(a[k][w].items()) == list(b[k][w].items()) for k in ('kw_counter', 'amt_counter') for w in a[k]) and a['kw_counter'].keys() == b['kw_counter'].keys()
+
+def main(sizes):
+    for n in sizes:
+        df = generar_procesado(n)
+        t0 = time.perf_counter(); ref = aprender_fila_a_fila(df); t_rows = time.perf_counter() - t0
+        core.concepto_tokens.clear()
+        t0 = time.perf_counter(); cold = aprender(df); t_cold = time.perf_counter() - t0
+        t0 = time.perf_counter(); warm = aprender(df); t_warm = time.perf_counter() - t0
+        assert iguales(ref, cold) and iguales(ref, warm)
+        print(f"{n:>8} filas | {df[desc].nunique():>7} conceptos distintos | fila a fila {t_rows:7.3f} s | caché fría {t_cold:7.3f} s | caliente {t_warm:7.3f} s | x{t_rows / max(t_warm, 1e-9):6.1f}")
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or [10_000, 100_000, 1_000_000])
@@ -0,0 +1,55 @@
+# --- Generador de extractos bancarios sintéticos con el esquema CSV de la app ---
+import numpy as np
+import pandas as pd
+
+COMERCIOS = [
+    ("COMPRA TARJ. MERCADONA {n} MADRID", "MERCADONA", "ALIMENTACIÓN", "SUPERMERCADO"),
+    ("COMPRA TARJ. CARREFOUR EXPRESS {n}", "CARREFOUR", "ALIMENTACIÓN", "SUPERMERCADO"),
+    ("PAGO MOVIL EN LIDL {n}", "LIDL", "ALIMENTACIÓN", "SUPERMERCADO"),
+    ("AMZN Mktp ES*{n}", "AMAZON", "COMPRAS", "AMAZON"),
+    ("NETFLIX.COM {n}", "NETFLIX", "SUSCRIPCIONES", "NETFLIX"),
+    ("RECIBO IBERDROLA CLIENTES {n}", "IBERDROLA", "SUMINISTROS", "ELECTRICIDAD"),
+    ("COMPRA TARJ. REPSOL ESTACION {n} GASOLINA", "REPSOL", "COCHE", "CARBURANTE"),
+    ("COMPRA TARJ. SHELL {n}", "SHELL", "COCHE", "CARBURANTE"),
+    ("FARMACIA LDO GARCIA {n}", "", "SALUD", "FARMACIA"),
+    ("PANADERIA HORNO SANTIAGO {n}", "HORNO SANTIAGO", "ALIMENTACIÓN", "PANADERIA"),
+    ("RESTAURANTE TABERNA PEPE {n}", "TABERNA PEPE", "OCIO", "RESTAURANTES"),
+    ("LIBRERIA CENTRAL {n}", "", "EDUCACION", "LIBROS"),
+    ("GIMNASIO FITLIFE CUOTA {n}", "FITLIFE", "ACTIVIDADES", "GIMNASIO"),
+    ("VETERINARIO MASCOTAS {n}", "", "MASCOTAS", "VETERINARIO"),
+    ("COMPRA TARJ. FERRETERIA LUIS {n} 12/03", "", "VARIOS HOGAR", "MANTENIMIENTO"),
+    ("CINESA PROYECCIONES {n}", "CINESA", "OCIO", "CINE"),
+    ("PAGO MOVIL EN CAFETERIA LUNA {n}", "", "OCIO", "CAFETERIAS"),
+    ("APPLE.COM/BILL {n}", "APPLE", "SUSCRIPCIONES", "APPLE ONE"),
+    ("TRANSFERENCIA A FAVOR DE ALQUILER CASTILLO {n}", "", "ALQUILER", "CASTILLO DE AREVALO"),
+    ("PARKING PLAZA MAYOR {n}", "", "COCHE", "PARKING"),
+]
+CUENTAS = ["EVO", "BBVA", "ING", "SANTANDER"]
+
+def generar_extracto(n_filas, frac_sin_categoria=0.5, n_variantes=200, seed=0):
+    # Devuelve un DataFrame con las columnas del CSV original (IMPORTE con coma decimal, AÑO/MES/DIA como texto)
+    rng = np.random.default_rng(seed)
+    idx_com = rng.integers(0, len(COMERCIOS), n_filas)
+    variante = rng.integers(0, n_variantes, n_filas)
+    plantillas = np.array([c[0] for c in COMERCIOS], dtype=object)
+    conceptos = [plantillas[i].format(n=1000 + v) for i, v in zip(idx_com, variante)]
+    tipo = rng.choice(["GASTO", "GASTO", "GASTO", "GASTO", "RECIBO", "INGRESO", "TRASPASO", "REEMBOLSO"], n_filas)
+    importe = np.round(rng.gamma(2.0, 25.0, n_filas), 2) * np.where(np.isin(tipo, ["GASTO", "RECIBO"]), -1, 1)
+    sin_cat = rng.random(n_filas) < frac_sin_categoria
+    cat = np.where(sin_cat, "", np.array([c[2] for c in COMERCIOS], dtype=object)[idx_com])
+    sub = np.where(sin_cat, "", np.array([c[3] for c in COMERCIOS], dtype=object)[idx_com])
+    fechas = pd.Timestamp("2019-01-01") + pd.to_timedelta(rng.integers(0, 6 * 365, n_filas), unit="D")
+    return pd.DataFrame({
+        "IMPORTE": pd.Series(importe).map("{:.2f}".format).str.replace(".", ",", regex=False),
+        "TIPO": tipo, "CATEGORÍA": cat, "SUBCATEGORIA": sub,
+        "AÑO": fechas.year.astype(str), "MES": fechas.month.astype(str), "DIA": fechas.day.astype(str),
+        "CONCEPTO": conceptos, "COMERCIO": np.where(rng.random(n_filas) < 0.5, "", np.array([c[1] for c in COMERCIOS], dtype=object)[idx_com]),
+        "CUENTA": rng.choice(CUENTAS, n_filas),
+    })
+
+def generar_procesado(n_filas, categorical=False, **kwargs):
+    # Extracto ya normalizado por el mismo código que usa la app (importe numérico, Fecha, Año/Mes, placeholders)
+    import gastos_familiares_core as core
+    df = generar_extracto(n_filas, **kwargs)
+    vacias = ["CATEGORÍA", "SUBCATEGORIA", "COMERCIO"]; df[vacias] = df[vacias].replace("", np.nan) # Como read_csv con campos vacíos
+    return core.normalize_transactions(df, categorical=categorical)[0]
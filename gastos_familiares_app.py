@@ -2,14 +2,21 @@ import streamlit as st
 import pandas as pd
 import calendar
 import traceback
-import re
-from collections import Counter, defaultdict
+import os
+import glob
+import sys
+import sqlite3
+import time
+import tempfile
+import numpy as np
+from collections import defaultdict
+from gastos_familiares_core import (CUBE_DIMS, EXPORT_FORMATS, KNOWLEDGE_DB_PATH, ConceptoSearchIndex, ExportCache, KnowledgeStore, apply_category_suggestions, apply_row_edits, apply_stored_edits,
+                                    build_aggregate_cube, derive_category_hierarchy, derive_comercio_map, diff_edited_rows, filter_cube,
+                                    invalid_category_mask, learn_categories, load_transactions, new_category_knowledge, process_csv_stream, relearn_edited_rows, select_rows, sorted_positions,
+                                    update_aggregate_cube, Profiler, stage, CLI_COMMANDS, cli)
 
 # --- Diccionario Global para Almacenar Conocimiento de Categorías ---
-category_knowledge = {
-    "keyword_map": {},
-    "amount_map": {}
-}
+category_knowledge = new_category_knowledge()
 
 # --- Session State para Configuraciones ---
 if 'edited_df' not in st.session_state: st.session_state.edited_df = None
@@ -17,6 +24,8 @@ if 'data_processed' not in st.session_state: st.session_state.data_processed = F
 if 'last_uploaded_filename' not in st.session_state: st.session_state.last_uploaded_filename = None
 if 'category_hierarchy' not in st.session_state: st.session_state.category_hierarchy = defaultdict(set)
 if 'comercio_to_category_map' not in st.session_state: st.session_state.comercio_to_category_map = {}
+if 'category_knowledge' not in st.session_state: st.session_state.category_knowledge = category_knowledge
+category_knowledge = st.session_state.get('category_knowledge', category_knowledge) # El modelo aprendido sobrevive a los reruns
 
 # --- Funciones Auxiliares ---
 meses_es = { 1: "Ene", 2: "Feb", 3: "Mar", 4: "Abr", 5: "May", 6: "Jun", 7: "Jul", 8: "Ago", 9: "Sep", 10: "Oct", 11: "Nov", 12: "Dic" }
@@ -24,124 +33,126 @@ def obtener_nombre_mes(n):
     try: return meses_es.get(int(n), str(n))
     except: return str(n)
 
-@st.cache_data
-def convert_df_to_csv(df_to_convert):
-    df_download = df_to_convert.copy()
-    if 'importe' in df_download.columns: df_download.rename(columns={'importe': 'IMPORTE'}, inplace=True)
-    if 'IMPORTE' in df_download.columns:
-        df_download['IMPORTE'] = pd.to_numeric(df_download['IMPORTE'], errors='coerce')
-        df_download['IMPORTE'] = df_download['IMPORTE'].map('{:.2f}'.format).str.replace('.', ',', regex=False); df_download['IMPORTE'].fillna('0,00', inplace=True)
-    df_download = df_download.drop(columns=['original_index', 'temp_id'], errors='ignore')
-    return df_download.to_csv(index=False, sep=';', decimal=',').encode('utf-8')
-
-def clean_text(t):
-    if not isinstance(t, str) or pd.isna(t): return ""
-    t = t.lower(); t = re.sub(r'\b\d{4,}\b', '', t); t = re.sub(r'\d{1,2}[/-]\d{1,2}([/-]\d{2,4})?', '', t); t = re.sub(r'[^\w\s]', ' ', t); t = re.sub(r'\s+', ' ', t).strip(); return t
-
-keywords_to_ignore = { 'pago', 'movil', 'en', 'compra', 'tarjeta', 'tarj', 'internet', 'comision', 'recibo', 'favor', 'de', 'la', 'el', 'los', 'las', 'a', 'con', 'sl', 'sa', 'sau', 's l', 'concepto', 'nº', 'ref', 'mandato', 'cuenta', 'gastos', 'varios', 'madrid', 'huelva', 'rozas', 'espanola', 'europe', 'fecha', 'num', 'enero', 'febrero', 'marzo', 'abril', 'mayo', 'junio', 'julio', 'agosto', 'septiembre', 'octubre', 'noviembre', 'diciembre', 'transferencia', 'trf', 'bizum', 'liquidacin', 'contrato', 'impuesto', 'cotizacion', 'tgss', 'iban', 'swift', 'com', 'www', 'http', 'https', 'cliente', 'importe', 'saldo', 'valor', 'atm', 'reintegro', 'oficina', 'suc', 'sr', 'sra', 'dna', 'bill', 'pending', 'uber', 'comercial', 'petroleo', 'obo', 'inv', 'for', 'sueldo', 'salar', 'nombre', 'miguel', 'angel', 'gonzalez', 'doval', 'alicia', 'jimenez', 'corpa', 'ordenante', 'beneficiario' }
-
-def learn_categories(df, concepto_col, cat_col, subcat_col, importe_col, placeholder_cat, placeholder_sub):
-    global category_knowledge, keywords_to_ignore; kw_counter = {}; amt_counter = {}
-    df_cat = df[ (df[cat_col] != placeholder_cat) & (df[subcat_col] != placeholder_sub) & (~df[cat_col].isin(['TRASPASO', 'RECIBO'])) ].copy()
-    if df_cat.empty: return
-    df_cat['clean'] = df_cat[concepto_col].apply(clean_text)
-    for _, r in df_cat.iterrows():
-        cat = r[cat_col]; sub = r[subcat_col]; imp = r[importe_col]
-        amt_bin = int(round(imp / 10) * 10) if pd.notna(imp) and isinstance(imp, (int, float)) else 0
-        cleaned_text_val = r['clean']
-        if cleaned_text_val is None: cleaned_text_val = "" # Seguridad extra
-        words = set(cleaned_text_val.split()) - keywords_to_ignore
-        for w in words:
-            if len(w) < 4: continue
-            kw_counter.setdefault(w, Counter())[(cat, sub)] += 1
-            amt_counter.setdefault((w, amt_bin), Counter())[(cat, sub)] += 1
-    category_knowledge["keyword_map"] = {w: c.most_common(1)[0][0] for w, c in kw_counter.items() if c}
-    category_knowledge["amount_map"] = {k: c.most_common(1)[0][0] for k, c in amt_counter.items() if c}
-    st.sidebar.info(f"Aprendizaje: {len(category_knowledge['keyword_map'])} keywords.")
-
-def suggest_category(row, concepto_col, importe_col, cat_col, subcat_col, com_col):
-    global category_knowledge, keywords_to_ignore
-    # --- 0. Mapeo Comercio -> Categoría ---
-    comercio = row[com_col]
-    if isinstance(comercio, str) and comercio != '' and comercio in st.session_state.comercio_to_category_map:
-        default_cat = st.session_state.comercio_to_category_map[comercio]
-        default_sub = next(iter(st.session_state.category_hierarchy.get(default_cat, {''})), '')
-        return (default_cat, default_sub if default_sub else 'GENERAL')
-
-    # --- 1. Reglas Explícitas ---
-    concepto = row[concepto_col]; importe = row[importe_col]; concepto_lower = str(concepto).lower(); current_subcat_lower = str(row[subcat_col]).lower()
-    if "mercadona" in concepto_lower: return ('ALIMENTACIÓN', 'SUPERMERCADO')
-    if "carrefour" in concepto_lower: return ('ALIMENTACIÓN', 'SUPERMERCADO')
-    if "dia supermercado" in concepto_lower or "dia s.a" in concepto_lower : return ('ALIMENTACIÓN', 'SUPERMERCADO')
-    if "lidl" in concepto_lower: return ('ALIMENTACIÓN', 'SUPERMERCADO')
-    if "ahorramas" in concepto_lower: return ('ALIMENTACIÓN', 'SUPERMERCADO')
-    if "supercor" in concepto_lower: return ('ALIMENTACIÓN', 'SUPERMERCADO')
-    if "alcampo" in concepto_lower: return ('ALIMENTACIÓN', 'SUPERMERCADO')
-    if "el corte ingles" in concepto_lower: return ('COMPRAS', 'EL CORTE INGLES')
-    if "amazon" in concepto_lower or "amzn" in concepto_lower: return ('COMPRAS', 'AMAZON')
-    if "glovo" in concepto_lower: return ('ALIMENTACIÓN', 'ONLINE')
-    if "apple.com/bill" in concepto_lower: return ('SUSCRIPCIONES', 'APPLE ONE')
-    if "netflix.com" in concepto_lower: return ('SUSCRIPCIONES', 'NETFLIX')
-    if "spotify" in concepto_lower: return ('SUSCRIPCIONES', 'SPOTIFY')
-    if "hbo" in concepto_lower or "max help.max.co" in concepto_lower: return ('SUSCRIPCIONES', 'HBO MAX')
-    if "disney plus" in concepto_lower: return ('SUSCRIPCIONES', 'DISNEY')
-    if "movistar" in concepto_lower or "telefonica" in concepto_lower: return ('SUSCRIPCIONES', 'MOVISTAR')
-    if "iberdrola" in concepto_lower: return ('SUMINISTROS', 'ELECTRICIDAD')
-    if "endesax.com" in concepto_lower: return ('SUMINISTROS', 'ELECTRICIDAD')
-    if "naturgy" in concepto_lower: return ('SUMINISTROS', 'GAS')
-    if "canal de isabel ii" in concepto_lower: return ('SUMINISTROS', 'AGUA')
-    if "podo" in concepto_lower or "geo alternativa" in concepto_lower : return ('SUMINISTROS', 'ELECTRICIDAD/GAS')
-    if ("cepsa" in concepto_lower or "repsol" in concepto_lower or "galp" in concepto_lower or "shell" in concepto_lower) and ("carburante" in current_subcat_lower or "gasolin" in concepto_lower): return ('COCHE', 'CARBURANTE')
-    if "farmacia" in concepto_lower or "fcia." in concepto_lower: return ('SALUD', 'FARMACIA')
-    if "colegio punta galea" in concepto_lower: return ('COLEGIO', 'MENSUALIDAD')
-    if "paypal *uber" in concepto_lower or "cabify" in concepto_lower: return ('TRANSPORTE', 'TAXI')
-    if "renfe" in concepto_lower or "emt " in concepto_lower or "metro de madrid" in concepto_lower: return ('TRANSPORTE', 'PUBLICO')
-    if "autopista" in concepto_lower or "peaje" in concepto_lower: return ('COCHE', 'PEAJE')
-    if "parking" in concepto_lower or "aparcamiento" in concepto_lower or "easypark" in concepto_lower: return ('COCHE', 'PARKING')
-    if "alquiler castillo" in concepto_lower: return ('ALQUILER', 'CASTILLO DE AREVALO')
-    if "itevelesa" in concepto_lower: return ('COCHE', 'ITV')
-    if "decathlon" in concepto_lower: return ('ROPA', 'DEPORTE')
-    if "leroy merlin" in concepto_lower or " leroymerlin" in concepto_lower: return ('VARIOS HOGAR', 'MANTENIMIENTO')
-    if "ikea" in concepto_lower: return ('VARIOS HOGAR', 'MUEBLES')
-    if "alexso" in concepto_lower: return ('CUIDADO PERSONAL', 'PELUQUERÍA')
-    if "duet sports" in concepto_lower or "ute padel" in concepto_lower: return ('ACTIVIDADES', 'PADEL')
-    # ... etc ...
-
-    # --- 2. Conocimiento Aprendido ---
-    cleaned_concepto = clean_text(concepto)
-    if cleaned_concepto is None: cleaned_concepto = "" # Seguridad extra
-    words = set(cleaned_concepto.split()) - keywords_to_ignore
-
-    amount_bin = int(round(importe / 10) * 10) if pd.notna(importe) and isinstance(importe, (int, float)) else 0
-    best_suggestion = None
-    for word in words:
-        if len(word) < 4: continue
-        key_amount = (word, amount_bin);
-        if key_amount in category_knowledge["amount_map"]: best_suggestion = category_knowledge["amount_map"][key_amount]; break
-    if best_suggestion is None:
-        for word in words:
-             if len(word) < 4: continue
-             if word in category_knowledge["keyword_map"]: best_suggestion = category_knowledge["keyword_map"][word]; break
-    return best_suggestion if best_suggestion else None
-
-def derive_category_hierarchy(df, cat_col, subcat_col, ph_cat, ph_sub):
-    hierarchy = defaultdict(set)
-    df_valid = df[(df[cat_col] != ph_cat) & (df[subcat_col] != ph_sub)].copy()
-    for cat, group in df_valid.groupby(cat_col):
-        hierarchy[cat].update(group[subcat_col].unique())
-    return hierarchy
-
-def derive_comercio_map(df, com_col, cat_col, ph_cat):
-    comercio_map = {}
-    df_valid = df[(df[com_col] != '') & (df[cat_col] != ph_cat)].copy()
-    if not df_valid.empty:
-        # Usar apply para manejar casos donde mode() podría estar vacío
-        comercio_map = df_valid.groupby(com_col)[cat_col].apply(lambda x: x.mode()[0] if not x.mode().empty else None).dropna().to_dict()
-    return comercio_map
+EXPORT_CHOICES = {"CSV": 'csv', "CSV comprimido (.gz)": 'csv.gz', "Parquet": 'parquet', "Excel (.xlsx)": 'xlsx'}
+
+def get_export_cache():
+    # Una caché de exportación por sesión; se invalida explícitamente al cambiar los datos (sin hashear el DataFrame)
+    if st.session_state.get('export_cache') is None: st.session_state.export_cache = ExportCache()
+    return st.session_state.export_cache
+
+def mark_rows_changed(df, index=None):
+    # Nueva versión de los datos: invalida los bloques exportados de esas filas y las posiciones cacheadas del editor
+    st.session_state.data_version = st.session_state.get('data_version', 0) + 1
+    get_export_cache().invalidate(df, index)
+
+def get_search_index(df, concepto_col):
+    # Se construye una vez por archivo (CONCEPTO no se edita) y se reutiliza en cada rerun
+    index = st.session_state.get('search_index')
+    if index is None or index.n_rows != len(df): index = st.session_state.search_index = ConceptoSearchIndex(df[concepto_col])
+    return index
+
+@st.cache_resource
+def get_knowledge_store(path=KNOWLEDGE_DB_PATH):
+    return KnowledgeStore(path)
+
+def sync_knowledge_from_store(store, force=False):
+    # Carga perezosa: sólo lee del almacén si otra sesión (o un reinicio) dejó una revisión distinta a la de esta sesión.
+    # Los contadores no se recargan: los deltas de otra sesión corresponden a ediciones que las filas de ésta no tienen.
+    # La jerarquía se une a la actual
+    revision = store.revision()
+    if not force and st.session_state.get('knowledge_revision') == revision: return False
+    st.session_state.comercio_to_category_map = {**st.session_state.get('derived_comercio_map', {}), **store.load_comercio_map()}
+    hierarchy = st.session_state.category_hierarchy
+    for c, subs in store.load_hierarchy().items(): hierarchy.setdefault(c, set()).update(subs)
+    st.session_state.knowledge_revision = revision
+    return True
+
+def persist_to_store(store, method, *args):
+    # Las escrituras en el almacén no deben romper la sesión: si fallan se avisa y se sigue en memoria
+    if store is None: return
+    try: st.session_state.knowledge_revision = getattr(store, method)(*args)
+    except sqlite3.Error as e: st.sidebar.warning(f"No se pudo guardar en el almacén de conocimiento: {e}")
+
+STREAM_RESULT_PREFIX = 'gastos_bloques_'; STREAM_RESULT_MAX_AGE = 24 * 3600 # segundos
+
+def new_stream_output():
+    # Un archivo temporal propio por ejecución (todas las sesiones comparten proceso); se borra el anterior de esta sesión
+    # y los de cualquier sesión con más de STREAM_RESULT_MAX_AGE, que ya no se van a descargar
+    previous = st.session_state.get('stream_result')
+    paths = [previous['output']] if previous else []
+    now = time.time()
+    for path in glob.glob(os.path.join(tempfile.gettempdir(), f"{STREAM_RESULT_PREFIX}*.csv")):
+        try:
+            if now - os.path.getmtime(path) > STREAM_RESULT_MAX_AGE: paths.append(path)
+        except OSError: pass
+    for path in paths:
+        try: os.remove(path)
+        except OSError: pass
+    st.session_state.stream_result = None
+    fd, path = tempfile.mkstemp(prefix=STREAM_RESULT_PREFIX, suffix='.csv'); os.close(fd)
+    return path
+
+def render_stream_mode(uploaded_file, knowledge_store):
+    # Modo por bloques: el archivo no se carga en la sesión; se descarga el CSV categorizado y se muestra el resumen del cubo
+    st.info("Modo por bloques: las categorías se sugieren automáticamente y el resultado se descarga como CSV (sin edición interactiva).")
+    ran = st.button("▶️ Procesar por bloques", key='run_stream')
+    if ran:
+        progress = st.empty()
+        out_path = new_stream_output()
+        stored_map = knowledge_store.load_comercio_map() if knowledge_store is not None else {}
+        stored_hierarchy = knowledge_store.load_hierarchy() if knowledge_store is not None else {}
+        try:
+            t0 = time.perf_counter()
+            # Modelo propio de la ejecución: no sustituye al de la sesión ni se guarda en el almacén (no hay instantánea por
+            # archivo que reutilizar y sustituiría la del archivo de otra sesión, cuyas ediciones dejarían de sumarse)
+            result = process_csv_stream(uploaded_file, out_path, comercio_map=stored_map, hierarchy=stored_hierarchy,
+                                        on_chunk=lambda fase, filas: progress.info(f"{fase.capitalize()}: {filas:,} filas..."))
+        except Exception as e:
+            os.remove(out_path); st.error(f"Error procesando por bloques: {e}"); st.code(traceback.format_exc()); return
+        progress.empty()
+        result.pop('knowledge', None); result.update(file=uploaded_file.name, output=out_path, seconds=time.perf_counter() - t0)
+        st.session_state.stream_result = result
+        st.session_state.comercio_to_category_map = result['comercio_map']; st.session_state.category_hierarchy = result['hierarchy']
+        persist_to_store(knowledge_store, 'save_hierarchy', result['hierarchy'])
+    result = st.session_state.get('stream_result')
+    if not result or result.get('file') != uploaded_file.name: return
+    st.success(f"{result['rows']:,} filas procesadas en {result['seconds']:.1f} s; {result['suggestions']:,} categorías sugeridas."
+               + (f" {result['invalid_rows']} filas con fechas inválidas eliminadas." if result['invalid_rows'] else ""))
+    cube_g = filter_cube(result['cube'], TIPO=['GASTO'])
+    if not cube_g.empty:
+        st.subheader("Gastos por Categoría y Año")
+        piv = cube_g.pivot_table(values='importe', index='CATEGORÍA', columns='Año', aggfunc='sum', fill_value=0, margins=True, margins_name='Total')
+        st.dataframe(piv.style.format('{:,.0f} €'), use_container_width=True)
+    # download_button lee el archivo entero y lo hashea: sólo se ofrece en la ejecución que lo generó, no en cada rerun.
+    # Una vez entregado al botón el temporal ya no hace falta
+    if not ran or not os.path.exists(result['output']):
+        st.caption("La descarga se ofrece al terminar el procesado: vuelve a procesar para descargar el CSV otra vez."); return
+    with open(result['output'], 'rb') as f:
+        st.download_button(label="📥 Descargar CSV Categorizado", data=f, file_name=f"Gastos_Cat_{pd.Timestamp.now().strftime('%Y%m%d_%H%M')}.csv", mime='text/csv', key='dl_stream')
+    try: os.remove(result['output'])
+    except OSError: pass
+
+# --- Diagnóstico de Rendimiento (opcional) ---
+def setup_diagnostics():
+    # Devuelve el Profiler de la sesión si el diagnóstico está activado; None en caso contrario (sin coste de medición)
+    with st.sidebar.expander("🩺 Diagnóstico"):
+        enabled = st.checkbox("Medir tiempos por etapa", key='diag_enabled')
+        track_memory = st.checkbox("Medir pico de memoria (más lento)", key='diag_memory', disabled=not enabled)
+    if not enabled: st.session_state.profiler = None; return None
+    profiler = st.session_state.get('profiler')
+    if profiler is None or profiler.track_memory != track_memory: profiler = st.session_state.profiler = Profiler(track_memory=track_memory)
+    return profiler
+
+def render_diagnostics(profiler):
+    summary = profiler.last_run()
+    with st.sidebar.expander("🩺 Última ejecución", expanded=True):
+        view = summary.assign(stage=['· ' * d + s for d, s in zip(summary['depth'], summary['stage'])])[['stage', 'rows', 'seconds', 'peak_mb']]
+        st.dataframe(view.rename(columns={'stage': 'Etapa', 'rows': 'Filas', 'seconds': 'Segundos', 'peak_mb': 'Pico MB'}), hide_index=True, use_container_width=True)
+        st.download_button("📥 Mediciones (JSON)", data=profiler.to_json().encode('utf-8'), file_name=f"diagnostico_{pd.Timestamp.now().strftime('%Y%m%d_%H%M')}.json", mime='application/json', key='dl_diag')
+        if st.button("🗑️ Reiniciar mediciones", key='reset_diag'): profiler.clear()
 
 # --- Función Principal Main ---
 def main():
-    st.set_page_config(layout="wide")
     st.title('Análisis Financiero y Configuración')
 
     if 'edited_df' not in st.session_state: st.session_state.edited_df = None
@@ -151,89 +162,95 @@ def main():
     if 'comercio_to_category_map' not in st.session_state: st.session_state.comercio_to_category_map = {}
 
     uploaded_file = st.file_uploader("Sube tu archivo CSV", type=["csv"], key="file_uploader")
+    try: knowledge_store = get_knowledge_store()
+    except (sqlite3.Error, OSError, RuntimeError) as e: st.sidebar.warning(f"Almacén de conocimiento no disponible: {e}"); knowledge_store = None
+    stream_mode = st.sidebar.checkbox("Procesar por bloques (archivos muy grandes)", key='stream_mode', help="Lee el CSV en bloques con memoria acotada; sin edición interactiva.")
+    if uploaded_file is not None and stream_mode: render_stream_mode(uploaded_file, knowledge_store); return
 
     if uploaded_file is not None:
         if 'last_uploaded_filename' not in st.session_state or st.session_state.last_uploaded_filename != uploaded_file.name:
-             st.session_state.edited_df = None; st.session_state.data_processed = False; st.session_state.last_uploaded_filename = uploaded_file.name; convert_df_to_csv.clear()
-             st.session_state.category_hierarchy = defaultdict(set); st.session_state.comercio_to_category_map = {}
+             st.session_state.edited_df = None; st.session_state.data_processed = False; st.session_state.last_uploaded_filename = uploaded_file.name; st.session_state.export_cache = None
+             st.session_state.category_hierarchy = defaultdict(set); st.session_state.comercio_to_category_map = {}; st.session_state.agg_cube = None; st.session_state.search_index = None
+             st.session_state.suggested_index = None; st.session_state.derived_comercio_map = {}; st.session_state.edit_positions = None
         if st.session_state.edited_df is None:
             try:
-                df_load = pd.read_csv(uploaded_file, sep=';', encoding='utf-8', dtype={'AÑO': str, 'MES': str, 'DIA': str})
-                st.session_state.edited_df = df_load.copy(); st.session_state.data_processed = False
+                t0 = time.perf_counter()
+                df_load, source_hash, from_cache, n_inv = load_transactions(uploaded_file.getvalue())
+                st.session_state.source_hash = source_hash
+                st.session_state.ingest_info = f"{'Leído de caché' if from_cache else 'CSV parseado'} en {time.perf_counter() - t0:.2f} s." + (f" {n_inv} filas con fechas inválidas eliminadas." if n_inv > 0 else "")
+                st.session_state.edited_df = df_load; st.session_state.data_processed = False
                 st.success(f"Archivo '{uploaded_file.name}' cargado. Procesando..."); st.experimental_rerun()
             except Exception as e: st.error(f"Error al cargar: {e}"); st.session_state.edited_df = None; return
     elif st.session_state.edited_df is None: st.info("Sube tu archivo CSV."); return
 
     if st.session_state.edited_df is not None and not st.session_state.data_processed:
-        df_processing = st.session_state.edited_df.copy()
+        df_processing = st.session_state.edited_df # Ya normalizado por load_transactions
         try:
-            df_processing.columns = df_processing.columns.str.strip()
-            imp_orig = 'IMPORTE'; tipo = 'TIPO'; cat = 'CATEGORÍA'; subcat = 'SUBCATEGORIA'; ano_col = 'AÑO'; mes_col = 'MES'; dia_col = 'DIA'; desc = 'CONCEPTO'; com = 'COMERCIO'; cta = 'CUENTA' # Nombres originales/claves
-            imp_calc = 'importe' # Nombre para cálculos
-            ano_calc = 'Año'; mes_calc = 'Mes' # Nombres para columnas calculadas
-            req_cols = [imp_orig, tipo, cat, subcat, ano_col, mes_col, dia_col, desc, com, cta];
-            missing = [c for c in req_cols if c not in df_processing.columns]; assert not missing, f"Faltan: {', '.join(missing)}"
-            df_processing.rename(columns={imp_orig: imp_calc}, inplace=True)
-            df_processing[imp_calc] = pd.to_numeric(df_processing[imp_calc].astype(str).str.replace(',', '.', regex=False), errors='coerce').fillna(0)
-            df_processing[ano_col]=df_processing[ano_col].astype(str); df_processing[mes_col]=df_processing[mes_col].astype(str).str.zfill(2); df_processing[dia_col]=df_processing[dia_col].astype(str).str.zfill(2)
-            df_processing['Fecha'] = pd.to_datetime( df_processing[ano_col] + '-' + df_processing[mes_col] + '-' + df_processing[dia_col], format='%Y-%m-%d', errors='coerce')
-            n_inv = df_processing['Fecha'].isnull().sum();
-            if n_inv > 0: st.warning(f"{n_inv} filas con fechas inválidas eliminadas.")
-            df_processing.dropna(subset=['Fecha'], inplace=True)
-            df_processing[ano_calc] = df_processing['Fecha'].dt.year.astype(int); df_processing[mes_calc] = df_processing['Fecha'].dt.month.astype(int) # Usar nombres calculados
+            cat = 'CATEGORÍA'; subcat = 'SUBCATEGORIA'; desc = 'CONCEPTO'; com = 'COMERCIO'; imp_calc = 'importe'
             ph_cat = 'SIN CATEGORÍA'; ph_sub = 'SIN SUBCATEGORÍA'
-            fill_cols = {cat: ph_cat, subcat: ph_sub, com: '', cta: 'SIN CUENTA', tipo: 'SIN TIPO'}
-            for c, ph in fill_cols.items():
-                 if c in df_processing.columns:
-                       df_processing[c] = df_processing[c].astype(str).replace(['nan', 'NaN', 'None', '<NA>'], pd.NA).fillna(ph)
-                       if ph == '': df_processing[c] = df_processing[c].replace('', ph)
-            mask_traspaso = df_processing[tipo] == 'TRASPASO'; df_processing.loc[mask_traspaso, cat] = 'TRASPASO'; df_processing.loc[mask_traspaso, subcat] = 'TRASPASO INTERNO'
-            mask_recibo = df_processing[tipo] == 'RECIBO'; df_processing.loc[mask_recibo, cat] = 'RECIBO'; df_processing.loc[mask_recibo, subcat] = 'PAGO RECIBO'
-            st.session_state.category_hierarchy = derive_category_hierarchy(df_processing, cat, subcat, ph_cat, ph_sub)
-            st.session_state.comercio_to_category_map = derive_comercio_map(df_processing, com, cat, ph_cat)
-            learn_categories(df_processing, desc, cat, subcat, imp_calc, ph_cat, ph_sub)
-            st.session_state.edited_df = df_processing.copy()
-            st.session_state.data_processed = True
+            source_hash = st.session_state.get('source_hash')
+            n_edits = apply_stored_edits(df_processing, knowledge_store, source_hash, cat, subcat) # Antes de derivar, aprender o reutilizar la instantánea
+            if n_edits: st.sidebar.info(f"{n_edits} ediciones guardadas reaplicadas.")
+            hierarchy = derive_category_hierarchy(df_processing, cat, subcat, ph_cat, ph_sub)
+            comercio_map = derive_comercio_map(df_processing, com, cat, ph_cat); st.session_state.derived_comercio_map = dict(comercio_map)
+            if knowledge_store is not None: # Los mapeos guardados en Configuración prevalecen sobre lo derivado
+                comercio_map.update(knowledge_store.load_comercio_map())
+                for c, subs in knowledge_store.load_hierarchy().items(): hierarchy[c].update(subs)
+            st.session_state.category_hierarchy = hierarchy; st.session_state.comercio_to_category_map = comercio_map
+            st.session_state.agg_cube = build_aggregate_cube(df_processing, imp_calc)
+            if knowledge_store is not None and source_hash is not None and knowledge_store.source_hash() == source_hash:
+                category_knowledge.clear(); category_knowledge.update(knowledge_store.load_knowledge()) # Modelo ya aprendido de este mismo archivo
+                st.sidebar.info(f"Conocimiento cargado del almacén: {len(category_knowledge['keyword_map'])} keywords.")
+            else:
+                n_keywords = learn_categories(df_processing, desc, cat, subcat, imp_calc, ph_cat, ph_sub, category_knowledge)
+                st.sidebar.info(f"Aprendizaje: {n_keywords} keywords.")
+                persist_to_store(knowledge_store, 'save_knowledge', category_knowledge, source_hash)
+            persist_to_store(knowledge_store, 'save_hierarchy', hierarchy)
+            st.session_state.data_processed = True; st.session_state.data_version = st.session_state.get('data_version', 0) + 1 # Datos nuevos (o con ediciones reaplicadas)
             st.sidebar.success("Datos procesados.")
             st.experimental_rerun()
         except Exception as e_proc: st.error(f"Error procesando: {e_proc}"); st.code(traceback.format_exc()); st.session_state.edited_df = None; st.session_state.data_processed = False; return
 
     if st.session_state.get('data_processed', False) and st.session_state.edited_df is not None:
-        df = st.session_state.edited_df.copy()
+        if knowledge_store is not None: sync_knowledge_from_store(knowledge_store)
+        if st.session_state.get('ingest_info'): st.sidebar.caption(st.session_state.ingest_info)
+        df = st.session_state.edited_df # Sólo lectura: los botones modifican el DataFrame de sesión en su sitio
         # Definir nombres de columna a usar en las pestañas
         tipo = 'TIPO'; cat = 'CATEGORÍA'; subcat = 'SUBCATEGORIA'; ano = 'Año'; mes = 'Mes'; desc = 'CONCEPTO'; com = 'COMERCIO'; cta = 'CUENTA'; imp_calc = 'importe'; ph_cat = 'SIN CATEGORÍA'; ph_sub = 'SIN SUBCATEGORÍA'
 
-        uncategorized_mask = (df[cat] == ph_cat); num_uncategorized = df[uncategorized_mask].shape[0]
+        if st.session_state.get('agg_cube') is None: st.session_state.agg_cube = build_aggregate_cube(df, imp_calc)
+        cube = st.session_state.agg_cube # Los informes leen del cubo; las transacciones sólo se recorren para el detalle
+        uncategorized_mask = (df[cat] == ph_cat); num_uncategorized = int(uncategorized_mask.sum())
         if num_uncategorized > 0: st.sidebar.warning(f"⚠️ {num_uncategorized} trans. sin CATEGORÍA.")
 
         tab_gastos, tab_pl, tab_categorizar, tab_config = st.tabs(["📊 Gastos", "📈 P&L EVO", "🏷️ Categorizar", "⚙️ Configuración"])
 
         with tab_gastos:
              st.header("Análisis Detallado de Gastos")
-             val_gasto = ["GASTO"]; df_g_tab = df[df[tipo].isin(val_gasto)].copy()
-             if not df_g_tab.empty:
-                 st.sidebar.header("Filtros Gastos"); años_g = sorted([int(a) for a in df_g_tab[ano].dropna().unique()]); año_g_s = st.sidebar.selectbox("Año (G):", años_g, key='sel_a_g')
-                 df_g_a = df_g_tab[df_g_tab[ano] == año_g_s]
-                 if not df_g_a.empty:
-                      ctas_g = sorted(df_g_a[cta].unique()); ctas_g_s = st.sidebar.multiselect("Cuentas (G):", options=ctas_g, default=ctas_g, key='sel_cta_g')
+             val_gasto = ["GASTO"]; cube_g = filter_cube(cube, TIPO=val_gasto)
+             if not cube_g.empty:
+                 st.sidebar.header("Filtros Gastos"); años_g = sorted([int(a) for a in cube_g[ano].dropna().unique()]); año_g_s = st.sidebar.selectbox("Año (G):", años_g, key='sel_a_g')
+                 cube_g_a = cube_g[cube_g[ano] == año_g_s]
+                 if not cube_g_a.empty:
+                      ctas_g = sorted(cube_g_a[cta].unique()); ctas_g_s = st.sidebar.multiselect("Cuentas (G):", options=ctas_g, default=ctas_g, key='sel_cta_g')
                       if ctas_g_s:
-                           df_g_f = df_g_a[df_g_a[cta].isin(ctas_g_s)].copy()
-                           if not df_g_f.empty:
+                           cube_g_f = cube_g_a[cube_g_a[cta].isin(ctas_g_s)]
+                           if not cube_g_f.empty:
                                 st.subheader(f"Resumen ({año_g_s} - {', '.join(ctas_g_s)})")
                                 try:
-                                     piv_g = df_g_f.pivot_table(values=imp_calc, index=cat, columns=mes, aggfunc='sum', fill_value=0, margins=True, margins_name='Total')
+                                     with stage('pivote_gastos', len(cube_g_f)): piv_g = cube_g_f.pivot_table(values=imp_calc, index=cat, columns=mes, aggfunc='sum', fill_value=0, margins=True, margins_name='Total')
                                      fmt = '{:,.0f} €'; sty = [ {'selector': 'th.col_heading, th.row_heading', 'props': [('background-color', '#6c757d'), ('color', 'white'), ('font-weight', 'bold')]}, {'selector': 'th.col_heading', 'props': [('text-align', 'center')]}, {'selector': 'th.row_heading', 'props': [('text-align', 'left')]}, {'selector': 'tr:last-child td, td:last-child', 'props': [('font-weight', 'bold'), ('background-color', '#f8f9fa')]} ]
                                      st.dataframe(piv_g.style.format(fmt).set_table_styles(sty), use_container_width=True)
                                 except Exception as e: st.error(f"Error pivote G: {e}")
-                                st.subheader("Detalle"); cats_f = sorted(df_g_f[cat].unique()); mes_f = sorted(df_g_f[mes].unique())
+                                st.subheader("Detalle"); cats_f = sorted(cube_g_f[cat].dropna().unique()); mes_f = sorted(cube_g_f[mes].unique())
                                 if cats_f and mes_f:
                                      c1,c2=st.columns(2);
                                      with c1: cat_s=st.selectbox("Cat:", cats_f, key='cat_det_g');
                                      with c2: mes_s=st.selectbox("Mes:", mes_f, key='mes_det_g')
-                                     df_det=df_g_f[(df_g_f[cat]==cat_s)&(df_g_f[mes]==mes_s)]
+                                     df_det=select_rows(df, df[tipo].isin(val_gasto) & (df[ano]==año_g_s) & df[cta].isin(ctas_g_s) & (df[cat]==cat_s) & (df[mes]==mes_s))
                                      if not df_det.empty:
                                           st.write(f"**Detalle: {cat_s}, Mes {mes_s}, Año {año_g_s}**")
-                                          det=df_det.groupby([subcat, desc, com, cta, 'Fecha'])[imp_calc].sum().reset_index().sort_values(by=imp_calc, ascending=True)
+                                          det=df_det.groupby([subcat, desc, com, cta, 'Fecha'], observed=True)[imp_calc].sum().reset_index().sort_values(by=imp_calc, ascending=True)
                                           det['Fecha']=pd.to_datetime(det['Fecha']).dt.strftime('%Y-%m-%d'); det[imp_calc]=det[imp_calc].map('{:,.2f} €'.format)
                                           st.dataframe(det, use_container_width=True, height=300)
                                      else: st.info("No hay detalle.")
@@ -244,13 +261,13 @@ def main():
              else: st.info("No hay GASTOS.")
 
         with tab_pl:
-             st.header("Análisis P&L - Cuenta Familiar (EVO)"); df_evo = df[df[cta] == 'EVO'].copy()
-             if not df_evo.empty:
-                 st.sidebar.header("Filtro P&L"); años_pl = sorted([int(a) for a in df_evo[ano].dropna().unique()]); año_pl_s = st.sidebar.selectbox("Año (P&L):", años_pl, key='sel_a_pl')
-                 df_evo_a = df_evo[df_evo[ano] == año_pl_s]
-                 if not df_evo_a.empty:
-                      tip_in = ['TRASPASO', 'INGRESO', 'REEMBOLSO']; df_i = df_evo_a[df_evo_a[tipo].isin(tip_in)]; ing_m = df_i.groupby(mes)[imp_calc].sum()
-                      tip_eg = ['GASTO', 'RECIBO']; df_e = df_evo_a[df_evo_a[tipo].isin(tip_eg)]; egr_m = df_e.groupby(mes)[imp_calc].sum().abs()
+             st.header("Análisis P&L - Cuenta Familiar (EVO)"); cube_evo = filter_cube(cube, CUENTA='EVO')
+             if not cube_evo.empty:
+                 st.sidebar.header("Filtro P&L"); años_pl = sorted([int(a) for a in cube_evo[ano].dropna().unique()]); año_pl_s = st.sidebar.selectbox("Año (P&L):", años_pl, key='sel_a_pl')
+                 cube_evo_a = cube_evo[cube_evo[ano] == año_pl_s]
+                 if not cube_evo_a.empty:
+                      tip_in = ['TRASPASO', 'INGRESO', 'REEMBOLSO']; df_i = filter_cube(cube_evo_a, TIPO=tip_in); ing_m = df_i.groupby(mes)[imp_calc].sum()
+                      tip_eg = ['GASTO', 'RECIBO']; df_e = filter_cube(cube_evo_a, TIPO=tip_eg); egr_m = df_e.groupby(mes)[imp_calc].sum().abs()
                       df_pnl = pd.DataFrame({'Ingresos': ing_m, 'Egresos': egr_m}).fillna(0); df_pnl['Resultado'] = df_pnl['Ingresos'] - df_pnl['Egresos']
                       tot_pl = df_pnl.sum(); tot_pl.name = 'Total'; df_pnl = pd.concat([df_pnl, tot_pl.to_frame().T]); df_pnl.index = df_pnl.index.map(obtener_nombre_mes)
                       fmt = '{:,.2f} €'; df_pnl_f = df_pnl.style.format(fmt).applymap(lambda x: 'color: green' if x > 0 else ('color: red' if x < 0 else 'color: black'), subset=['Resultado']).set_properties(**{'text-align': 'right'})
@@ -271,76 +288,106 @@ def main():
                 st.info(f"Hay {num_uncategorized} trans. sin CATEGORÍA.")
                 if st.button("🤖 Sugerir CATEGORÍAS Faltantes", key="suggest_cats"):
                     # Redefinir para el scope del botón
-                    cat_btn=cat_editor; subcat_btn=subcat_editor; desc_btn=desc_editor; imp_calc_btn=imp_calc_editor; imp_orig_btn='IMPORTE'; ph_cat_btn=ph_cat_editor; ph_sub_btn=ph_sub_editor; com_btn=com_editor
-                    suggestions_applied = 0; df_suggest = st.session_state.edited_df.copy()
-                    if imp_orig_btn in df_suggest.columns: df_suggest.rename(columns={imp_orig_btn: imp_calc_btn}, inplace=True)
-                    if imp_calc_btn not in df_suggest.columns: raise KeyError("Falta importe")
-                    if not pd.api.types.is_numeric_dtype(df_suggest[imp_calc_btn]): df_suggest[imp_calc_btn] = pd.to_numeric(df_suggest[imp_calc_btn].astype(str).str.replace(',', '.', regex=False), errors='coerce').fillna(0)
-                    suggest_mask = (df_suggest[cat_btn] == ph_cat_btn); indices_to_update = df_suggest[suggest_mask].index
-                    for index in indices_to_update:
-                        row = df_suggest.loc[index]; sugg_result = suggest_category(row, desc_btn, imp_calc_btn, cat_btn, subcat_btn, com_btn)
-                        applied_c = False
-                        if sugg_result is not None:
-                           sugg_cat, sugg_sub = sugg_result
-                           if sugg_cat and df_suggest.loc[index, cat_btn] == ph_cat_btn: df_suggest.loc[index, cat_btn] = sugg_cat; applied_c = True
-                           if sugg_sub and df_suggest.loc[index, subcat_btn] == ph_sub_btn:
-                               if applied_c or (sugg_cat is None and df_suggest.loc[index, cat_btn] != ph_cat_btn): df_suggest.loc[index, subcat_btn] = sugg_sub; applied_c = True
-                        if applied_c: suggestions_applied += 1
-                    if suggestions_applied > 0: st.session_state.edited_df = df_suggest.copy(); st.success(f"Se aplicaron {suggestions_applied} sugerencias."); convert_df_to_csv.clear(); st.experimental_rerun()
+                    cat_btn=cat_editor; subcat_btn=subcat_editor; desc_btn=desc_editor; imp_calc_btn=imp_calc_editor; ph_cat_btn=ph_cat_editor; ph_sub_btn=ph_sub_editor; com_btn=com_editor
+                    # Se aplica en su sitio sobre el DataFrame de sesión (ya normalizado: importe numérico), una asignación por columna
+                    df_suggest = st.session_state.edited_df; old_rows = df_suggest.loc[uncategorized_mask, CUBE_DIMS + [imp_calc_btn]]
+                    suggestions_applied = apply_category_suggestions(df_suggest, desc_btn, imp_calc_btn, cat_btn, subcat_btn, com_btn, ph_cat_btn, ph_sub_btn,
+                                                                     st.session_state.comercio_to_category_map, st.session_state.category_hierarchy, category_knowledge)
+                    if suggestions_applied > 0: st.session_state.agg_cube = update_aggregate_cube(cube, old_rows, df_suggest.loc[old_rows.index, CUBE_DIMS + [imp_calc_btn]], imp_calc_btn)
+                    if suggestions_applied > 0: # Las etiquetas sugeridas no se aprenden: se recuerdan para no retirarlas del modelo si luego se editan
+                        suggested = old_rows.index[(df_suggest.loc[old_rows.index, cat_btn] != ph_cat_btn).to_numpy()]
+                        prev = st.session_state.get('suggested_index'); st.session_state.suggested_index = suggested if prev is None else prev.union(suggested)
+                    if suggestions_applied > 0: mark_rows_changed(df_suggest, old_rows.index); st.success(f"Se aplicaron {suggestions_applied} sugerencias."); st.experimental_rerun()
                     else: st.info("No se encontraron sugerencias.")
             else: st.success("¡Todo categorizado!")
 
             st.subheader("Editar Transacciones")
             col_f1, col_f2, col_f3 = st.columns([1,1,2]);
             with col_f1: show_uncat_edit = st.checkbox("Solo sin CATEGORÍA", value=(num_uncategorized > 0), key='chk_uncat_edit', disabled=(num_uncategorized == 0))
-            with col_f2: year_opts = ["Todos"] + sorted([int(a) for a in df[ano_editor].dropna().unique()]); year_sel = st.selectbox("Año:", year_opts, key='sel_a_edit')
+            with col_f2: year_opts = ["Todos"] + sorted([int(a) for a in cube[ano_editor].dropna().unique()]); year_sel = st.selectbox("Año:", year_opts, key='sel_a_edit')
             with col_f3: txt_filter = st.text_input("Buscar Desc:", key='txt_edit_filter')
-            df_display_edit = st.session_state.edited_df.copy(); display_mask = (df_display_edit[cat_editor] == ph_cat_editor)
-            if show_uncat_edit: df_display_edit = df_display_edit[display_mask]
-            if year_sel != "Todos":
-                 if ano_editor in df_display_edit.columns: df_display_edit = df_display_edit[df_display_edit[ano_editor] == year_sel]
-                 else: st.error(f"Columna '{ano_editor}' no encontrada.")
-            if txt_filter: df_display_edit = df_display_edit[df_display_edit[desc_editor].str.contains(txt_filter, case=False, na=False)]
-            df_display_edit['original_index'] = df_display_edit.index
-            cats_opts = sorted([str(c) for c in st.session_state.edited_df[cat_editor].unique() if pd.notna(c) and c != ph_cat_editor])
-            subcats_opts = sorted([str(s) for s in st.session_state.edited_df[subcat_editor].unique() if pd.notna(s) and s != ph_sub_editor])
+            # Paginación en el servidor: al navegador sólo se envía la página actual
+            sort_opts = {"Orden original": None, "Fecha": 'Fecha', "Importe": imp_calc_editor, "Concepto": desc_editor, "Categoría": cat_editor}
+            col_p1, col_p2, col_p3, col_p4 = st.columns([2,1,1,1])
+            with col_p1: sort_label = st.selectbox("Ordenar por:", list(sort_opts), key='edit_sort_col')
+            with col_p2: sort_asc = st.checkbox("Ascendente", value=True, key='edit_sort_asc')
+            with col_p3: page_size = st.selectbox("Filas/página:", [50, 100, 250, 500], index=1, key='edit_page_size')
+            view_sig = (show_uncat_edit, year_sel, txt_filter, sort_label, sort_asc, page_size)
+            # Filtrado y orden sólo cuando cambia la vista o los datos: los reruns de otros widgets reutilizan las posiciones
+            positions_key = (view_sig, st.session_state.get('data_version', 0)); cached_positions = st.session_state.get('edit_positions')
+            if cached_positions is not None and cached_positions[0] == positions_key: positions = cached_positions[1]
+            else:
+                display_mask = np.ones(len(df), dtype=bool)
+                if show_uncat_edit: display_mask &= uncategorized_mask.to_numpy()
+                if year_sel != "Todos":
+                     if ano_editor in df.columns: display_mask &= (df[ano_editor] == year_sel).to_numpy()
+                     else: st.error(f"Columna '{ano_editor}' no encontrada.")
+                if txt_filter: display_mask &= get_search_index(df, desc_editor).search(txt_filter)
+                positions = sorted_positions(df, display_mask, sort_opts[sort_label], sort_asc)
+                st.session_state.edit_positions = (positions_key, positions)
+            n_pages = max(1, -(-len(positions) // page_size))
+            if st.session_state.get('edit_view_sig') != view_sig: # Nueva vista: se vuelve a la primera página
+                st.session_state.edit_view_sig = view_sig; st.session_state.edit_view_gen = st.session_state.get('edit_view_gen', 0) + 1; st.session_state.edit_page = 1
+            if st.session_state.get('edit_page', 1) > n_pages: st.session_state.edit_page = n_pages
+            with col_p4: page = st.number_input("Página:", min_value=1, max_value=n_pages, step=1, key='edit_page')
+            df_display_edit = df.iloc[positions[(page - 1) * page_size : page * page_size]]
+            df_display_edit = df_display_edit.assign(original_index=df_display_edit.index) # assign devuelve un DataFrame nuevo: el de sesión no cambia
+            st.caption(f"{len(positions)} filas · página {page} de {n_pages}. Aplica los cambios antes de cambiar de página o de filtro.")
+            cats_opts = sorted([str(c) for c in cube[cat_editor].unique() if pd.notna(c) and c != ph_cat_editor])
+            subcats_opts = sorted([str(s) for s in cube[subcat_editor].unique() if pd.notna(s) and s != ph_sub_editor])
             col_cfg = { cat_editor: st.column_config.SelectboxColumn(cat_editor, options=cats_opts, required=False),
                         subcat_editor: st.column_config.SelectboxColumn(subcat_editor, options=subcats_opts, required=False),
                         imp_calc_editor: st.column_config.NumberColumn("Importe", format="%.2f €"),
                         'Fecha': st.column_config.DateColumn("Fecha", format="YYYY-MM-DD"),
                         'original_index': None, ano_editor: None, mes_editor: None, }
-            edited_data = st.data_editor( df_display_edit, column_config=col_cfg, use_container_width=True, num_rows="dynamic", key='data_editor_main', hide_index=True, height=400 )
+            # La clave cambia con la vista y la página para que las ediciones pendientes no se apliquen a otras filas
+            editor_key = f"data_editor_main_{st.session_state.edit_view_gen}_{page}"
+            with stage('editor_pagina', len(df_display_edit)): st.data_editor( df_display_edit, column_config=col_cfg, use_container_width=True, num_rows="fixed", key=editor_key, hide_index=True, height=400 )
 
             if st.button("💾 Aplicar Cambios Editados", key="apply_manual_changes"):
                 # Redefinir locales para este botón
                 cat_btn_apply = cat_editor; subcat_btn_apply = subcat_editor; desc_btn_apply = desc_editor; ph_sub_btn_apply = ph_sub_editor
 
-                changes_manual = 0; df_session = st.session_state.edited_df; edit_cols = [cat_btn_apply, subcat_btn_apply]
-                invalid_combinations = []; valid_hierarchy = st.session_state.category_hierarchy
-                temp_df_session = df_session.copy()
-                indices_edited = edited_data['original_index']
-                if indices_edited.is_unique:
-                    temp_df_session.loc[indices_edited, edit_cols] = edited_data[edit_cols].values
-                    for idx in indices_edited:
-                        edited_cat = temp_df_session.loc[idx, cat_btn_apply]; edited_subcat = temp_df_session.loc[idx, subcat_btn_apply]
-                        if edited_cat in valid_hierarchy and edited_subcat not in valid_hierarchy[edited_cat] and edited_subcat != ph_sub_btn_apply and edited_subcat != '':
-                            invalid_combinations.append({ "Índice": idx, "Concepto": temp_df_session.loc[idx, desc_btn_apply], "Cat": edited_cat, "SubCat Inválida": edited_subcat, "SubCats Válidas": ", ".join(sorted(list(valid_hierarchy[edited_cat]))) if valid_hierarchy[edited_cat] else "Ninguna" })
-                    if not invalid_combinations:
-                        st.session_state.edited_df = temp_df_session.copy()
-                        changes_manual = len(indices_edited)
-                        st.success(f"{changes_manual} filas actualizadas."); convert_df_to_csv.clear(); st.experimental_rerun()
-                    else:
-                        st.error("Combinaciones Cat/SubCat inválidas. Cambios NO aplicados."); st.dataframe(pd.DataFrame(invalid_combinations), use_container_width=True)
-                else: st.error("Error: Índices duplicados.")
-
-            st.subheader("Descargar Datos"); st.caption("Descarga el CSV con las últimas categorías.")
-            csv_dl = convert_df_to_csv(st.session_state.edited_df)
-            st.download_button( label="📥 Descargar CSV Actualizado", data=csv_dl, file_name=f"Gastos_Cat_{pd.Timestamp.now().strftime('%Y%m%d_%H%M')}.csv", mime='text/csv', key='dl_cat')
+                df_session = st.session_state.edited_df; edit_cols = [cat_btn_apply, subcat_btn_apply]; valid_hierarchy = st.session_state.category_hierarchy
+                # Sólo las celdas que el usuario tocó (estado del editor), no toda la página
+                edited_rows = st.session_state.get(editor_key, {}).get('edited_rows', {})
+                old_rows, new_rows = diff_edited_rows(df_session, df_display_edit.index, edited_rows, edit_cols)
+                invalid = invalid_category_mask(new_rows, cat_btn_apply, subcat_btn_apply, valid_hierarchy, ph_sub_btn_apply)
+                if new_rows.empty: st.info("No hay cambios que aplicar.")
+                elif not invalid.any():
+                    suggested_index = st.session_state.get('suggested_index')
+                    knowledge_deltas = relearn_edited_rows(old_rows, new_rows, desc_btn_apply, cat_btn_apply, subcat_btn_apply, imp_calc_editor, ph_cat_editor, ph_sub_btn_apply, category_knowledge, suggested_index)
+                    if suggested_index is not None: st.session_state.suggested_index = suggested_index.difference(new_rows.index) # Tras editarlas, su etiqueta ya está en el modelo
+                    edits = dict(zip(new_rows.index, zip(new_rows[cat_btn_apply].to_numpy(dtype=object), new_rows[subcat_btn_apply].to_numpy(dtype=object))))
+                    persist_to_store(knowledge_store, 'apply_knowledge_delta', knowledge_deltas, st.session_state.get('source_hash'), edits)
+                    changes_manual = apply_row_edits(df_session, new_rows, edit_cols)
+                    st.session_state.agg_cube = update_aggregate_cube(cube, old_rows, new_rows, imp_calc_editor)
+                    mark_rows_changed(df_session, new_rows.index)
+                    st.success(f"{changes_manual} filas actualizadas."); st.experimental_rerun()
+                else:
+                    bad = new_rows[invalid.to_numpy()]
+                    invalid_combinations = pd.DataFrame({ "Índice": bad.index, "Concepto": bad[desc_btn_apply].to_numpy(), "Cat": bad[cat_btn_apply].to_numpy(dtype=object), "SubCat Inválida": bad[subcat_btn_apply].to_numpy(dtype=object),
+                                                          "SubCats Válidas": [", ".join(sorted(valid_hierarchy[c])) or "Ninguna" for c in bad[cat_btn_apply]] })
+                    st.error("Combinaciones Cat/SubCat inválidas. Cambios NO aplicados."); st.dataframe(invalid_combinations, use_container_width=True)
+
+            st.subheader("Descargar Datos"); st.caption("Descarga los datos con las últimas categorías. El archivo se genera al pedirlo; tras editar sólo se rehacen los bloques cambiados.")
+            export_cache = get_export_cache()
+            col_d1, col_d2 = st.columns([1,1])
+            with col_d1: export_label = st.selectbox("Formato:", list(EXPORT_CHOICES), key='export_fmt'); export_fmt = EXPORT_CHOICES[export_label]
+            # El botón de descarga sólo existe en el rerun que generó el archivo: en los demás no se pasan los bytes (ni se hashean)
+            with col_d2: prepared = st.button("⚙️ Preparar descarga", key='prepare_export')
+            if prepared:
+                try:
+                    with st.spinner("Generando archivo..."): data = export_cache.render(st.session_state.edited_df, export_fmt)
+                except ValueError as e: st.error(str(e))
+                else:
+                    mime, ext = EXPORT_FORMATS[export_fmt]
+                    st.download_button( label=f"📥 Descargar {export_label}", data=data, file_name=f"Gastos_Cat_{pd.Timestamp.now().strftime('%Y%m%d_%H%M')}.{ext}", mime=mime, key='dl_cat')
 
         with tab_config:
             st.header("⚙️ Configuración")
             st.write("Gestiona relaciones Categoría/Subcategoría y Comercio/Categoría.")
-            st.caption("Cambios guardados temporalmente en la sesión.")
+            st.caption("Cambios guardados en la sesión y en el almacén de conocimiento." if knowledge_store is not None else "Cambios guardados temporalmente en la sesión.")
             cat_cfg = cat; subcat_cfg = subcat; com_cfg = com; ph_cat_cfg = ph_cat
 
             st.subheader("Jerarquía Categoría -> Subcategorías")
@@ -355,7 +402,7 @@ def main():
             st.subheader("Asignar Categoría por Defecto a Comercios")
             comercio_map = st.session_state.comercio_to_category_map
             all_comercios = sorted([c for c in df[com_cfg].unique() if c != ''])
-            all_categories_cfg = sorted([c for c in df[cat_cfg].unique() if c != ph_cat_cfg])
+            all_categories_cfg = sorted([c for c in df[cat_cfg].unique() if pd.notna(c) and c != ph_cat_cfg])
             comercio_cfg_list = [{"COMERCIO": c, "CATEGORÍA Asignada": comercio_map.get(c, None)} for c in all_comercios]
             df_comercio_cfg = pd.DataFrame(comercio_cfg_list)
             comercio_editor_cfg = { "COMERCIO": st.column_config.TextColumn("Comercio", disabled=True), "CATEGORÍA Asignada": st.column_config.SelectboxColumn("Cat. por Defecto", options=[None] + all_categories_cfg, required=False) }
@@ -369,7 +416,14 @@ def main():
                     st.success("Mapeo Comercio -> Categoría actualizado.")
                     # Re-derivar jerarquía por si afecta
                     ph_sub_cfg = ph_sub # Necesitamos ph_sub aquí
-                    st.session_state.category_hierarchy = derive_category_hierarchy(st.session_state.edited_df, cat_cfg, subcat_cfg, ph_cat_cfg, ph_sub_cfg)
+                    hierarchy = derive_category_hierarchy(st.session_state.edited_df, cat_cfg, subcat_cfg, ph_cat_cfg, ph_sub_cfg)
+                    if knowledge_store is not None: # Como al procesar: se conservan los pares de otros archivos
+                        for c, subs in knowledge_store.load_hierarchy().items(): hierarchy[c].update(subs)
+                    st.session_state.category_hierarchy = hierarchy
+                    # Se guardan sólo los mapeos que difieren de lo derivado del archivo; los de comercios de otros archivos se conservan
+                    derived_map = st.session_state.get('derived_comercio_map', {})
+                    persist_to_store(knowledge_store, 'save_comercio_map', {c: v for c, v in new_map.items() if derived_map.get(c) != v}, set(all_comercios))
+                    persist_to_store(knowledge_store, 'save_hierarchy', st.session_state.category_hierarchy)
                 else: st.info("No se detectaron cambios en el mapeo.")
 
     # --- Manejo de Errores Final ---
@@ -379,4 +433,11 @@ def main():
     #     st.session_state.edited_df = None; st.session_state.data_processed = False
 
 if __name__ == "__main__":
-    main()
+    # python -m gastos_familiares_app categorize ... usa la línea de comandos del núcleo; streamlit run abre la app
+    if len(sys.argv) > 1 and sys.argv[1] in CLI_COMMANDS: sys.exit(cli(sys.argv[1:]))
+    st.set_page_config(layout="wide") # Debe ser la primera llamada de la página, antes del panel de diagnóstico
+    profiler = setup_diagnostics()
+    if profiler is None: main()
+    else:
+        with profiler.activate(label='rerun'), stage('rerun'): main()
+        render_diagnostics(profiler)
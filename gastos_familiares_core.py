@@ -0,0 +1,1098 @@
+# --- Núcleo sin Streamlit: ingesta, normalización, aprendizaje, sugerencias, agregados y almacén de conocimiento ---
+# Lo importan la app (gastos_familiares_app.py), los benchmarks y la línea de comandos:
+#   python -m gastos_familiares_core categorize extracto.csv [otro.csv ...] -o salida.csv [--model store] [--workers 4]
+import pandas as pd
+import re
+import os
+import sys
+import csv
+import sqlite3
+import hashlib
+import io
+import gzip
+import time
+import argparse
+import functools
+import json
+import contextvars
+import tracemalloc
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing, contextmanager
+import numpy as np
+from collections import Counter, OrderedDict, defaultdict, deque
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError: # Sin pyarrow la exportación CSV usa sólo pandas (mismo resultado, más lenta)
+    pa = None
+
+# Copy-on-write: las selecciones y filtros no se copian de forma defensiva; sólo se duplica la columna que se modifica
+pd.set_option('mode.copy_on_write', True)
+
+# --- Diccionario Global para Almacenar Conocimiento de Categorías ---
+# keyword_map / amount_map son el argmax de los contadores kw_counter / amt_counter, que admiten altas y bajas de filas
+def new_category_knowledge():
+    return {"keyword_map": {}, "amount_map": {}, "kw_counter": {}, "amt_counter": {}}
+
+category_knowledge = new_category_knowledge()
+
+# --- Instrumentación: tiempo, filas y pico de memoria por etapa ---
+# Sólo mide si hay un Profiler activo en el contexto actual (cada sesión de Streamlit corre en su propio hilo);
+# sin él, stage() y @instrumented no hacen nada. tracemalloc es global del proceso: con varias sesiones midiendo
+# memoria a la vez los picos se mezclan.
+_active_profiler = contextvars.ContextVar('gastos_profiler', default=None)
+
+class Profiler:
+    def __init__(self, track_memory=False, max_records=2000):
+        self.track_memory = track_memory; self.records = deque(maxlen=max_records); self.run = 0; self.run_label = None; self._stack = []
+
+    @contextmanager
+    def activate(self, label=None):
+        # Cada activación es una ejecución (p.ej. un rerun de la app); las etapas anidadas guardan su profundidad
+        self.run += 1; self.run_label = label; token = _active_profiler.set(self)
+        started = self.track_memory and not tracemalloc.is_tracing()
+        if started: tracemalloc.start()
+        try: yield self
+        finally:
+            _active_profiler.reset(token)
+            if started: tracemalloc.stop()
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        rec = {'run': self.run, 'label': self.run_label, 'stage': name, 'depth': len(self._stack), 'rows': rows, 'seconds': None, 'peak_mb': None}
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            if self._stack: self._stack[-1]['_peak'] = max(self._stack[-1]['_peak'], peak) # reset_peak borra el pico de la etapa padre
+            tracemalloc.reset_peak(); rec['_base'] = rec['_peak'] = current
+        self._stack.append(rec); self.records.append(rec); t0 = time.perf_counter() # En orden de inicio: la etapa padre antes que sus hijas
+        try: yield rec
+        finally:
+            rec['seconds'] = time.perf_counter() - t0; self._stack.pop()
+            if tracing: rec['peak_mb'] = (max(rec.pop('_peak'), tracemalloc.get_traced_memory()[1]) - rec.pop('_base')) / 2**20
+
+    def last_run(self):
+        return pd.DataFrame([r for r in self.records if r['run'] == self.run], columns=['run', 'label', 'stage', 'depth', 'rows', 'seconds', 'peak_mb'])
+
+    def to_json(self):
+        return json.dumps({'track_memory': self.track_memory, 'records': list(self.records)}, ensure_ascii=False, indent=1)
+
+    def clear(self):
+        self.records.clear(); self.run = 0
+
+@contextmanager
+def stage(name, rows=None):
+    # with stage('normalizacion') as rec: ...; rec['rows'] = len(df)
+    profiler = _active_profiler.get()
+    if profiler is None: yield {}; return
+    with profiler.stage(name, rows) as rec: yield rec
+
+def instrumented(name, rows_arg=0):
+    # Decorador: mide la función como etapa, con len() del argumento posicional rows_arg como nº de filas
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            if _active_profiler.get() is None: return fn(*args, **kwargs)
+            with stage(name, len(args[rows_arg]) if rows_arg is not None and len(args) > rows_arg else None): return fn(*args, **kwargs)
+        return inner
+    return wrap
+
+# --- Funciones Auxiliares ---
+def export_frame(df_to_convert):
+    # Formato del CSV de descarga: IMPORTE con coma decimal y sin columnas auxiliares del editor
+    df_download = df_to_convert.rename(columns={'importe': 'IMPORTE'})
+    if 'IMPORTE' in df_download.columns:
+        df_download['IMPORTE'] = pd.to_numeric(df_download['IMPORTE'], errors='coerce')
+        df_download['IMPORTE'] = map_distinct(df_download['IMPORTE'], lambda u: u.map('{:.2f}'.format).str.replace('.', ',', regex=False)).fillna('0,00') # Un format por importe distinto
+    return df_download.drop(columns=['original_index', 'temp_id'], errors='ignore')
+
+def clean_text(t):
+    if not isinstance(t, str) or pd.isna(t): return ""
+    t = t.lower(); t = re.sub(r'\b\d{4,}\b', '', t); t = re.sub(r'\d{1,2}[/-]\d{1,2}([/-]\d{2,4})?', '', t); t = re.sub(r'[^\w\s]', ' ', t); t = re.sub(r'\s+', ' ', t).strip(); return t
+
+keywords_to_ignore = { 'pago', 'movil', 'en', 'compra', 'tarjeta', 'tarj', 'internet', 'comision', 'recibo', 'favor', 'de', 'la', 'el', 'los', 'las', 'a', 'con', 'sl', 'sa', 'sau', 's l', 'concepto', 'nº', 'ref', 'mandato', 'cuenta', 'gastos', 'varios', 'madrid', 'huelva', 'rozas', 'espanola', 'europe', 'fecha', 'num', 'enero', 'febrero', 'marzo', 'abril', 'mayo', 'junio', 'julio', 'agosto', 'septiembre', 'octubre', 'noviembre', 'diciembre', 'transferencia', 'trf', 'bizum', 'liquidacin', 'contrato', 'impuesto', 'cotizacion', 'tgss', 'iban', 'swift', 'com', 'www', 'http', 'https', 'cliente', 'importe', 'saldo', 'valor', 'atm', 'reintegro', 'oficina', 'suc', 'sr', 'sra', 'dna', 'bill', 'pending', 'uber', 'comercial', 'petroleo', 'obo', 'inv', 'for', 'sueldo', 'salar', 'nombre', 'miguel', 'angel', 'gonzalez', 'doval', 'alicia', 'jimenez', 'corpa', 'ordenante', 'beneficiario' }
+
+def clean_text_series(s):
+    # Versión vectorizada de clean_text (mismo resultado, valores no texto -> "")
+    s = s.str.lower()
+    s = s.str.replace(r'\b\d{4,}\b', '', regex=True).str.replace(r'\d{1,2}[/-]\d{1,2}([/-]\d{2,4})?', '', regex=True)
+    s = s.str.replace(r'[^\w\s]', ' ', regex=True).str.replace(r'\s+', ' ', regex=True).str.strip()
+    return s.fillna("")
+
+# --- Tokenización de CONCEPTO: cada concepto distinto se limpia y trocea una sola vez ---
+TOKEN_CACHE_SIZE = 200_000 # Conceptos distintos que se recuerdan (LRU)
+
+class TokenCache:
+    # concepto -> palabras útiles (limpias, sin keywords_to_ignore, de 4+ letras), en el orden en que las recorría el set.
+    # Es global del módulo, así que se conserva entre reruns de la app, bloques y archivos del mismo proceso. Las sesiones de
+    # Streamlit son hilos de ese proceso: el lock protege el OrderedDict (get + move_to_end y el desalojo no son atómicos);
+    # la limpieza de los conceptos nuevos, que es lo caro, se hace fuera de él.
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize; self.entries = OrderedDict(); self.hits = 0; self.misses = 0; self.lock = threading.Lock()
+
+    def lookup(self, values):
+        out = [()] * len(values); missing = []
+        with self.lock:
+            for i, v in enumerate(values):
+                if not isinstance(v, str): continue # Igual que clean_text: lo que no es texto no aporta palabras
+                words = self.entries.get(v)
+                if words is None: missing.append(i)
+                else: self.entries.move_to_end(v); out[i] = words
+        if missing:
+            cleaned = clean_text_series(pd.Series([values[i] for i in missing], dtype=object))
+            for i, c in zip(missing, cleaned): out[i] = tuple(w for w in set(c.split()) - keywords_to_ignore if len(w) >= 4)
+        with self.lock:
+            for i in missing: self.entries[values[i]] = out[i]
+            while len(self.entries) > self.maxsize: self.entries.popitem(last=False)
+            self.hits += len(values) - len(missing); self.misses += len(missing)
+        return out
+
+    def factorize(self, s):
+        # Códigos por fila y palabras de cada concepto distinto: words[codes[i]] son las de la fila i
+        codes, uniques = pd.factorize(s, use_na_sentinel=False)
+        return codes, self.lookup(list(uniques))
+
+    def words(self, value):
+        return self.lookup([value])[0]
+
+    def clear(self):
+        with self.lock: self.entries.clear(); self.hits = 0; self.misses = 0
+
+concepto_tokens = TokenCache()
+
+def factorize_rows(df, cols):
+    # pd.factorize sobre varias columnas: códigos por fila y combinaciones distintas (en orden de aparición) como DataFrame
+    codes = np.zeros(len(df), dtype='int64'); uniques = []
+    for c in cols:
+        c_codes, c_uniques = pd.factorize(df[c], use_na_sentinel=False); uniques.append(c_uniques)
+        codes = codes * len(c_uniques) + c_codes
+    codes, combos = pd.factorize(codes); parts = {}
+    for c, u in reversed(list(zip(cols, uniques))): parts[c] = np.asarray(u, dtype=object)[combos % len(u)]; combos = combos // len(u)
+    return codes, pd.DataFrame({c: parts[c] for c in cols})
+def map_distinct(s, fn):
+    # Aplica una transformación vectorizada a los valores distintos de s y la difunde a las filas con los códigos
+    codes, uniques = pd.factorize(s, use_na_sentinel=False)
+    return pd.Series(np.asarray(fn(pd.Series(np.asarray(uniques, dtype=object))))[codes], index=s.index, name=s.name)
+def calc_amount_bin(imp):
+    return int(round(imp / 10) * 10) if pd.notna(imp) and isinstance(imp, (int, float)) else 0
+
+def amount_bin_series(s):
+    if not pd.api.types.is_numeric_dtype(s) or pd.api.types.is_bool_dtype(s): return s.map(calc_amount_bin).astype('int64')
+    return (np.round(s.astype('float64') / 10) * 10).fillna(0).astype('int64')
+
+# --- Reglas Explícitas (tabla declarativa en reglas_categorias.csv) ---
+# Columnas: PRIORIDAD (menor = antes; gana la primera que coincide), PATRONES del concepto separados por '|',
+# CONDICION_CONCEPTO / CONDICION_SUBCATEGORIA opcionales (basta con que se cumpla una), CATEGORIA, SUBCATEGORIA.
+RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reglas_categorias.csv')
+
+def _split_patterns(value):
+    return tuple(p.lower() for p in (value or '').split('|') if p != '')
+
+def load_rule_table(path):
+    # Devuelve las reglas como (patrones, categoría, subcategoría, condición) ordenadas por prioridad
+    rules = []
+    with open(path, encoding='utf-8', newline='') as f:
+        for n_line, r in enumerate(csv.DictReader(f, delimiter=';'), start=2):
+            patterns = _split_patterns(r.get('PATRONES'))
+            if not patterns and not (r.get('CATEGORIA') or '').strip(): continue
+            try: priority = float(r['PRIORIDAD'])
+            except (TypeError, ValueError): raise ValueError(f"Regla inválida en línea {n_line}: PRIORIDAD '{r.get('PRIORIDAD')}'")
+            if not patterns or not (r.get('CATEGORIA') or '').strip(): raise ValueError(f"Regla inválida en línea {n_line}: faltan PATRONES o CATEGORIA")
+            cond_concepto = _split_patterns(r.get('CONDICION_CONCEPTO')); cond_subcat = _split_patterns(r.get('CONDICION_SUBCATEGORIA'))
+            cond = {'concepto': cond_concepto, 'subcategoria': cond_subcat} if cond_concepto or cond_subcat else None
+            rules.append((priority, len(rules), (patterns, r['CATEGORIA'].strip(), (r.get('SUBCATEGORIA') or '').strip(), cond)))
+    return [rule for _, _, rule in sorted(rules, key=lambda x: (x[0], x[1]))]
+
+def _trie_regex(node):
+    # Convierte un trie de patrones en una regex sin alternativas redundantes: en cada posición
+    # el motor sólo recorre la rama del carácter actual, así que el coste no crece con el número de reglas.
+    branches = []
+    for ch, child in sorted(node.items()):
+        if ch == '': continue
+        literal = re.escape(ch)
+        while len(child) == 1 and '' not in child:
+            (ch, child), = child.items(); literal += re.escape(ch)
+        sub = _trie_regex(child) if any(k != '' for k in child) else ''
+        if sub: literal += f"(?:{sub})?" if '' in child else f"(?:{sub})"
+        branches.append(literal)
+    return '|'.join(branches)
+
+class RuleMatcher:
+    # Compila todas las reglas en un único autómata (regex en forma de trie): una sola pasada por concepto
+    # devuelve todos los patrones presentes, y se resuelve la primera regla (por prioridad) que coincide.
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.rules_by_pattern = defaultdict(list)
+        for i, (patterns, _, _, cond) in enumerate(self.rules):
+            for p in patterns: self.rules_by_pattern[p].append(i)
+        all_patterns = set(self.rules_by_pattern)
+        for _, _, _, cond in self.rules:
+            if cond: all_patterns.update(cond.get('concepto', ()))
+        trie = {}
+        for p in all_patterns:
+            node = trie
+            for ch in p: node = node.setdefault(ch, {})
+            node[''] = p
+        # En cada posición la regex captura el patrón más largo; los patrones que son prefijo suyo también están presentes
+        self.prefixes = {}
+        for p in all_patterns:
+            node = trie; found = []
+            for ch in p:
+                node = node[ch]
+                if '' in node: found.append(node[''])
+            self.prefixes[p] = found
+        alternatives = _trie_regex(trie)
+        self.regex = re.compile(f'(?=({alternatives}))') if alternatives else None
+
+    def patterns_in(self, text):
+        found = set()
+        if self.regex is None: return found
+        for m in self.regex.finditer(text): found.update(self.prefixes[m.group(1)])
+        return found
+
+    def match(self, concepto_lower, subcat_lower=''):
+        found = self.patterns_in(concepto_lower)
+        candidates = sorted({i for p in found for i in self.rules_by_pattern.get(p, ())})
+        for i in candidates:
+            _, cat, sub, cond = self.rules[i]
+            if cond and not (any(p in found for p in cond.get('concepto', ())) or any(p in subcat_lower for p in cond.get('subcategoria', ()))): continue
+            return (cat, sub)
+        return None
+
+@functools.lru_cache(maxsize=8)
+def _load_rule_matcher(path, mtime):
+    return RuleMatcher(load_rule_table(path)) if mtime is not None else RuleMatcher([])
+
+def get_rule_matcher(path=RULES_PATH):
+    # Se compila una vez por versión del fichero de reglas (la clave incluye la fecha de modificación)
+    return _load_rule_matcher(path, os.path.getmtime(path) if os.path.exists(path) else None)
+
+def learnable_mask(df, cat_col, subcat_col, placeholder_cat, placeholder_sub):
+    return (df[cat_col] != placeholder_cat) & (df[subcat_col] != placeholder_sub) & (~df[cat_col].isin(['TRASPASO', 'RECIBO']))
+
+def _refresh_argmax(counters, argmax_map, keys):
+    for k in keys:
+        c = counters.get(k)
+        if c is not None:
+            for label in [label for label, n in c.items() if n <= 0]: del c[label]
+        if c: argmax_map[k] = c.most_common(1)[0][0]
+        else: counters.pop(k, None); argmax_map.pop(k, None)
+
+def update_category_knowledge(df_rows, concepto_col, cat_col, subcat_col, importe_col, sign=1, knowledge=None):
+    # Añade (sign=1) o retira (sign=-1) filas etiquetadas del modelo; sólo se recalcula el argmax de las claves tocadas.
+    # Se recorre cada combinación distinta (concepto, tramo, cat, subcat) una vez, con su nº de filas y en orden de aparición,
+    # así que los contadores (y el orden de sus etiquetas) quedan igual que fila a fila. Devuelve el delta {(palabra, tramo, cat, subcat): n}.
+    if knowledge is None: knowledge = category_knowledge
+    if df_rows.empty: return Counter()
+    kw_counter = knowledge["kw_counter"]; amt_counter = knowledge["amt_counter"]; touched_kw = set(); touched_amt = set(); delta = Counter()
+    concepto_codes, words_by_concepto = concepto_tokens.factorize(df_rows[concepto_col])
+    combo_codes, combos = factorize_rows(pd.DataFrame({'c': concepto_codes, 'b': amount_bin_series(df_rows[importe_col]).to_numpy(),
+                                                       'cat': df_rows[cat_col].to_numpy(), 'sub': df_rows[subcat_col].to_numpy()}), ['c', 'b', 'cat', 'sub'])
+    counts = (np.bincount(combo_codes) * sign).tolist()
+    for c, amt_bin, cat, sub, n in zip(combos['c'], combos['b'], combos['cat'], combos['sub'], counts):
+        label = (cat, sub)
+        for w in words_by_concepto[c]:
+            kw = kw_counter.get(w)
+            if kw is None: kw = kw_counter[w] = Counter()
+            amt = amt_counter.get((w, amt_bin))
+            if amt is None: amt = amt_counter[(w, amt_bin)] = Counter()
+            kw[label] += n; amt[label] += n; touched_kw.add(w); touched_amt.add((w, amt_bin))
+            delta[(w, amt_bin, cat, sub)] += n
+    _refresh_argmax(kw_counter, knowledge["keyword_map"], touched_kw)
+    _refresh_argmax(amt_counter, knowledge["amount_map"], touched_amt)
+    return delta
+
+@instrumented('aprendizaje')
+def learn_categories(df, concepto_col, cat_col, subcat_col, importe_col, placeholder_cat, placeholder_sub, knowledge=None, executor=None, n_shards=1):
+    # Aprendizaje completo (al procesar un archivo); las ediciones posteriores usan update_category_knowledge.
+    # Con executor (pool de procesos) cada fragmento de filas se cuenta en paralelo y los contadores se suman en orden.
+    if knowledge is None: knowledge = category_knowledge
+    knowledge.update(new_category_knowledge())
+    df_cat = df[learnable_mask(df, cat_col, subcat_col, placeholder_cat, placeholder_sub)]
+    if df_cat.empty: return 0
+    if executor is None or n_shards <= 1: update_category_knowledge(df_cat, concepto_col, cat_col, subcat_col, importe_col, 1, knowledge)
+    else:
+        cols = [concepto_col, cat_col, subcat_col, importe_col]
+        parts = executor.map(functools.partial(_learn_shard, cols=cols), row_shards(df_cat[cols], n_shards))
+        merge_knowledge_counters(knowledge, parts)
+    return len(knowledge['keyword_map'])
+
+def relearn_edited_rows(old_rows, new_rows, concepto_col, cat_col, subcat_col, importe_col, placeholder_cat, placeholder_sub, knowledge=None, unlearned_index=None):
+    # Delta de aprendizaje para filas editadas: retira la etiqueta anterior y añade la nueva (sólo si cambió).
+    # unlearned_index: filas cuya etiqueta actual nunca entró en el modelo (p.ej. sugeridas); su etiqueta anterior no se retira.
+    # Devuelve [delta retirado, delta añadido]: el almacén los aplica por separado y en orden, igual que aquí, para que las
+    # etiquetas que se borran y vuelven a entrar queden en el mismo orden (decide los empates de most_common)
+    changed = (old_rows[cat_col].astype(object) != new_rows[cat_col].astype(object)) | (old_rows[subcat_col].astype(object) != new_rows[subcat_col].astype(object))
+    old_rows = old_rows[changed]; new_rows = new_rows[changed]
+    learned = learnable_mask(old_rows, cat_col, subcat_col, placeholder_cat, placeholder_sub)
+    if unlearned_index is not None: learned &= ~old_rows.index.isin(unlearned_index)
+    retracted = update_category_knowledge(old_rows[learned], concepto_col, cat_col, subcat_col, importe_col, -1, knowledge)
+    added = update_category_knowledge(new_rows[learnable_mask(new_rows, cat_col, subcat_col, placeholder_cat, placeholder_sub)], concepto_col, cat_col, subcat_col, importe_col, 1, knowledge)
+    return [retracted, added]
+
+def suggest_category(row, concepto_col, importe_col, cat_col, subcat_col, com_col, comercio_map=None, hierarchy=None, rule_matcher=None):
+    global category_knowledge
+    if comercio_map is None: comercio_map = {}
+    if hierarchy is None: hierarchy = {}
+    # --- 0. Mapeo Comercio -> Categoría ---
+    comercio = row[com_col]
+    if isinstance(comercio, str) and comercio != '' and comercio in comercio_map:
+        default_cat = comercio_map[comercio]
+        default_sub = next(iter(hierarchy.get(default_cat, {''})), '')
+        return (default_cat, default_sub if default_sub else 'GENERAL')
+
+    # --- 1. Reglas Explícitas ---
+    concepto = row[concepto_col]; importe = row[importe_col]; concepto_lower = str(concepto).lower(); current_subcat_lower = str(row[subcat_col]).lower()
+    explicit = (rule_matcher or get_rule_matcher()).match(concepto_lower, current_subcat_lower)
+    if explicit is not None: return explicit
+
+    # --- 2. Conocimiento Aprendido ---
+    words = concepto_tokens.words(concepto)
+
+    amount_bin = calc_amount_bin(importe)
+    best_suggestion = None
+    for word in words:
+        if len(word) < 4: continue
+        key_amount = (word, amount_bin);
+        if key_amount in category_knowledge["amount_map"]: best_suggestion = category_knowledge["amount_map"][key_amount]; break
+    if best_suggestion is None:
+        for word in words:
+             if len(word) < 4: continue
+             if word in category_knowledge["keyword_map"]: best_suggestion = category_knowledge["keyword_map"][word]; break
+    return best_suggestion if best_suggestion else None
+
+def _suggest_from_words(words, amt_bin, knowledge):
+    best_suggestion = None
+    for word in words:
+        if len(word) < 4: continue
+        if (word, amt_bin) in knowledge["amount_map"]: best_suggestion = knowledge["amount_map"][(word, amt_bin)]; break
+    if best_suggestion is None:
+        for word in words:
+            if len(word) < 4: continue
+            if word in knowledge["keyword_map"]: best_suggestion = knowledge["keyword_map"][word]; break
+    return best_suggestion
+
+def _combine_codes(codes_a, n_b, codes_b):
+    # Factoriza pares (a, b) a partir de sus códigos: devuelve códigos de par y los pares únicos como (códigos_a, códigos_b)
+    pair_codes, pair_uniques = pd.factorize(codes_a.astype('int64') * max(n_b, 1) + codes_b)
+    return pair_codes, pair_uniques // max(n_b, 1), pair_uniques % max(n_b, 1)
+
+def suggest_categories_batch(df, concepto_col, importe_col, cat_col, subcat_col, com_col, comercio_map=None, hierarchy=None, knowledge=None, rule_matcher=None):
+    # Igual que suggest_category fila a fila (misma precedencia), pero sobre toda la columna:
+    # cada concepto/comercio distinto se evalúa una sola vez y el resultado se difunde con los códigos de factorize.
+    if comercio_map is None: comercio_map = {}
+    if hierarchy is None: hierarchy = {}
+    if knowledge is None: knowledge = category_knowledge
+    if rule_matcher is None: rule_matcher = get_rule_matcher()
+    n = len(df); sugg_cat = np.full(n, None, dtype=object); sugg_sub = np.full(n, None, dtype=object)
+    pending = np.ones(n, dtype=bool)
+    if n == 0: return pd.DataFrame({cat_col: sugg_cat, subcat_col: sugg_sub}, index=df.index)
+
+    # --- 0. Mapeo Comercio -> Categoría ---
+    valid_keys = [k for k in comercio_map if isinstance(k, str) and k != '']
+    if valid_keys:
+        com_codes, com_uniques = pd.factorize(df[com_col], use_na_sentinel=False)
+        uniq_hit = np.array([isinstance(c, str) and c != '' and c in comercio_map for c in com_uniques], dtype=bool)
+        uniq_cat = np.array([comercio_map[c] if h else None for c, h in zip(com_uniques, uniq_hit)], dtype=object)
+        uniq_sub = np.array([(next(iter(hierarchy.get(c, {''})), '') or 'GENERAL') if h else None for c, h in zip(uniq_cat, uniq_hit)], dtype=object)
+        hit = uniq_hit[com_codes]
+        sugg_cat[hit] = uniq_cat[com_codes[hit]]; sugg_sub[hit] = uniq_sub[com_codes[hit]]; pending &= ~hit
+
+    # --- 1. Reglas Explícitas (una pasada del autómata por par concepto/subcategoría distinto) ---
+    if pending.any():
+        idx = np.flatnonzero(pending)
+        c_codes, c_uniques = pd.factorize(df[concepto_col].iloc[idx].astype(str).str.lower())
+        s_codes, s_uniques = pd.factorize(df[subcat_col].iloc[idx].astype(str).str.lower())
+        pair_codes, pair_c, pair_s = _combine_codes(c_codes, len(s_uniques), s_codes)
+        matches = [rule_matcher.match(c_uniques[a], s_uniques[b]) for a, b in zip(pair_c, pair_s)]
+        uniq_cat = np.array([m[0] if m else None for m in matches], dtype=object); uniq_sub = np.array([m[1] if m else None for m in matches], dtype=object)
+        hit = np.array([m is not None for m in matches], dtype=bool)[pair_codes]
+        sugg_cat[idx[hit]] = uniq_cat[pair_codes[hit]]; sugg_sub[idx[hit]] = uniq_sub[pair_codes[hit]]; pending[idx[hit]] = False
+
+    # --- 2. Conocimiento Aprendido (por par concepto limpio/tramo de importe distinto) ---
+    if pending.any() and (knowledge["amount_map"] or knowledge["keyword_map"]):
+        idx = np.flatnonzero(pending)
+        raw_codes, words_by_raw = concepto_tokens.factorize(df[concepto_col].iloc[idx])
+        b_codes, b_uniques = pd.factorize(amount_bin_series(df[importe_col].iloc[idx]))
+        pair_codes, pair_w, pair_b = _combine_codes(raw_codes, len(b_uniques), b_codes)
+        results = [_suggest_from_words(words_by_raw[a], int(b_uniques[b]), knowledge) for a, b in zip(pair_w, pair_b)]
+        uniq_cat = np.array([r[0] if r else None for r in results], dtype=object); uniq_sub = np.array([r[1] if r else None for r in results], dtype=object)
+        hit = np.array([r is not None for r in results], dtype=bool)[pair_codes]
+        sugg_cat[idx[hit]] = uniq_cat[pair_codes[hit]]; sugg_sub[idx[hit]] = uniq_sub[pair_codes[hit]]
+
+    return pd.DataFrame({cat_col: sugg_cat, subcat_col: sugg_sub}, index=df.index)
+
+@instrumented('sugerencias')
+def apply_category_suggestions(df, concepto_col, importe_col, cat_col, subcat_col, com_col, ph_cat, ph_sub, comercio_map=None, hierarchy=None, knowledge=None, pool=None):
+    # Rellena CATEGORÍA (y SUBCATEGORIA si está vacía) de las filas sin categoría con una única asignación por columna.
+    # Modifica df en su sitio y devuelve el número de filas actualizadas. Con pool (SuggestionPool) las sugerencias
+    # salen de la copia del modelo que tiene el pool, no de comercio_map/hierarchy/knowledge.
+    target = df.index[(df[cat_col] == ph_cat).to_numpy()]
+    if len(target) == 0: return 0
+    if pool is not None: sugg = pool.suggest(df.loc[target], concepto_col, importe_col, cat_col, subcat_col, com_col)
+    else: sugg = suggest_categories_batch(df.loc[target], concepto_col, importe_col, cat_col, subcat_col, com_col, comercio_map, hierarchy, knowledge)
+    has_cat = sugg[cat_col].notna() & (sugg[cat_col] != '')
+    has_sub = has_cat & sugg[subcat_col].notna() & (sugg[subcat_col] != '') & (df.loc[target, subcat_col] == ph_sub)
+    if has_cat.any(): assign_values(df, target[has_cat.to_numpy()], cat_col, sugg.loc[has_cat, cat_col].to_numpy())
+    if has_sub.any(): assign_values(df, target[has_sub.to_numpy()], subcat_col, sugg.loc[has_sub, subcat_col].to_numpy())
+    return int(has_cat.sum())
+
+def derive_category_hierarchy(df, cat_col, subcat_col, ph_cat, ph_sub):
+    hierarchy = defaultdict(set)
+    df_valid = df.loc[(df[cat_col] != ph_cat) & (df[subcat_col] != ph_sub), [cat_col, subcat_col]]
+    for cat, group in df_valid.groupby(cat_col, observed=True):
+        hierarchy[cat].update(group[subcat_col].unique())
+    return hierarchy
+
+def derive_comercio_map(df, com_col, cat_col, ph_cat):
+    comercio_map = {}
+    df_valid = df.loc[(df[com_col] != '') & (df[cat_col] != ph_cat), [com_col, cat_col]]
+    if not df_valid.empty:
+        # Usar apply para manejar casos donde mode() podría estar vacío
+        comercio_map = df_valid.groupby(com_col, observed=True)[cat_col].apply(lambda x: x.mode()[0] if not x.mode().empty else None).dropna().to_dict()
+    return comercio_map
+
+def assign_values(df, index, col, values):
+    # Asignación in situ que admite columnas categóricas (añade antes las categorías nuevas)
+    if isinstance(df[col].dtype, pd.CategoricalDtype):
+        new_cats = pd.Index(pd.unique(np.asarray(values, dtype=object).ravel())).dropna().difference(df[col].cat.categories)
+        if len(new_cats): df[col] = df[col].cat.add_categories(new_cats)
+    df.loc[index, col] = values
+
+def select_rows(df, mask=None):
+    # Acceso de sólo lectura al DataFrame de sesión: una única indexación por la máscara combinada (sin .copy()).
+    # Sin máscara devuelve el propio DataFrame; con copy-on-write, escribir en el resultado nunca modifica el original.
+    return df if mask is None else df[mask]
+
+# --- Ediciones del editor: diferencias, validación de Cat/SubCat y aplicación sólo del delta ---
+def diff_edited_rows(df, view_index, edited_rows, cols):
+    # edited_rows es el estado de st.data_editor ({posición en la vista: {columna: valor}}). Devuelve (old_rows, new_rows)
+    # sólo con las filas cuyo valor en cols difiere de df (una celda devuelta a su valor original no cuenta como cambio).
+    edits = {int(pos): {c: v for c, v in changes.items() if c in cols} for pos, changes in edited_rows.items()}
+    edits = {pos: changes for pos, changes in edits.items() if changes}
+    if not edits: return df.iloc[:0], df.iloc[:0]
+    old_rows = df.loc[view_index[list(edits)]]
+    new_values = {c: np.array(old_rows[c].to_numpy(dtype=object), dtype=object, copy=True) for c in cols} # Con copy-on-write to_numpy() puede ser una vista de sólo lectura
+    for i, changes in enumerate(edits.values()):
+        for c, v in changes.items(): new_values[c][i] = v
+    changed = np.zeros(len(old_rows), dtype=bool)
+    for c in cols:
+        old = old_rows[c].to_numpy(dtype=object); new = new_values[c]
+        changed |= ~((old == new) | (pd.isna(old) & pd.isna(new)))
+    return old_rows[changed], old_rows.assign(**new_values)[changed]
+
+def category_pairs_table(hierarchy):
+    return pd.DataFrame([(c, s) for c, subs in hierarchy.items() for s in subs], columns=['cat', 'sub'], dtype=object)
+
+def invalid_category_mask(rows, cat_col, subcat_col, hierarchy, ph_sub):
+    # Regla del editor con un único merge contra la tabla de pares válidos: si la categoría tiene jerarquía,
+    # la subcategoría tiene que estar en ella, salvo que quede vacía o sin subcategoría.
+    keys = pd.DataFrame({'cat': rows[cat_col].to_numpy(dtype=object), 'sub': rows[subcat_col].to_numpy(dtype=object)})
+    valid_pair = keys.merge(category_pairs_table(hierarchy).assign(valida=True), on=['cat', 'sub'], how='left')['valida'].notna().to_numpy()
+    invalid = keys['cat'].isin(list(hierarchy)).to_numpy() & ~valid_pair & ~keys['sub'].isin([ph_sub, '']).to_numpy()
+    return pd.Series(invalid, index=rows.index)
+
+def apply_row_edits(df, new_rows, cols):
+    # Escribe en su sitio sólo las filas cambiadas; devuelve cuántas son
+    for c in cols: assign_values(df, new_rows.index, c, new_rows[c].to_numpy(dtype=object))
+    return len(new_rows)
+
+# --- Cubo de agregados para los informes (Gastos, P&L) ---
+# Suma de importes y nº de transacciones por combinación de dimensiones: su tamaño depende de la cardinalidad
+# de las dimensiones, no del nº de transacciones, así que filtrar y pivotar sobre él es O(1) respecto al histórico.
+CUBE_DIMS = ['Año', 'Mes', 'CUENTA', 'TIPO', 'CATEGORÍA', 'SUBCATEGORIA']
+
+@instrumented('cubo_agregados')
+def build_aggregate_cube(df, importe_col='importe'):
+    # dropna=False: las filas con CATEGORÍA vaciada en el editor siguen contando en los totales (como en las transacciones)
+    cube = df.groupby(CUBE_DIMS, observed=True, sort=False, dropna=False)[importe_col].agg(['sum', 'size']).reset_index()
+    cube.columns = CUBE_DIMS + [importe_col, 'n']
+    for c in CUBE_DIMS:
+        if isinstance(cube[c].dtype, pd.CategoricalDtype): cube[c] = cube[c].astype(object) # Se combina con filas editadas de cualquier dtype
+    return cube
+
+def update_aggregate_cube(cube, old_rows, new_rows, importe_col='importe'):
+    # Actualización incremental tras editar filas: resta su aportación anterior y suma la nueva (coste proporcional al cubo, no al histórico)
+    old = build_aggregate_cube(old_rows, importe_col); old[[importe_col, 'n']] *= -1
+    return merge_aggregate_cubes([cube, old, build_aggregate_cube(new_rows, importe_col)], importe_col)
+
+def merge_aggregate_cubes(cubes, importe_col='importe'):
+    # Suma celda a celda (p.ej. cubos parciales de cada bloque); descarta las celdas que se quedan sin transacciones
+    merged = pd.concat(cubes, ignore_index=True).groupby(CUBE_DIMS, sort=False, dropna=False)[[importe_col, 'n']].sum().reset_index()
+    return merged[merged['n'] > 0].reset_index(drop=True)
+
+def filter_cube(cube, **filters):
+    # Filtra por dimensión: un escalar compara por igualdad, una lista/tupla/conjunto por pertenencia
+    mask = pd.Series(True, index=cube.index)
+    for dim, value in filters.items(): mask &= cube[dim].isin(value) if isinstance(value, (list, tuple, set)) else (cube[dim] == value)
+    return cube[mask]
+
+# --- Editor paginado: índice de búsqueda sobre CONCEPTO y orden/página de las filas filtradas ---
+class ConceptoSearchIndex:
+    # Índice invertido de trigramas sobre los CONCEPTO distintos: una búsqueda intersecta las listas de sus trigramas
+    # y sólo comprueba la subcadena en esos candidatos; el resultado se difunde a las filas con los códigos de factorize.
+    def __init__(self, conceptos):
+        self.codes, uniques = pd.factorize(conceptos)
+        self.n_rows = len(self.codes)
+        self.lower = [str(u).lower() for u in uniques]
+        postings = defaultdict(list)
+        for i, text in enumerate(self.lower):
+            for gram in {text[j:j + 3] for j in range(len(text) - 2)}: postings[gram].append(i)
+        self.postings = {gram: np.array(ids, dtype=np.int64) for gram, ids in postings.items()}
+
+    def search(self, text):
+        # Máscara booleana por fila: el CONCEPTO contiene el texto (literal, sin distinguir mayúsculas)
+        q = text.lower()
+        if len(q) >= 3:
+            lists = sorted((self.postings.get(q[j:j + 3], np.empty(0, dtype=np.int64)) for j in range(len(q) - 2)), key=len)
+            candidates = lists[0]
+            for ids in lists[1:]:
+                if len(candidates) == 0: break
+                candidates = np.intersect1d(candidates, ids, assume_unique=True)
+        else: candidates = range(len(self.lower))
+        hit = np.zeros(len(self.lower) + 1, dtype=bool) # La última posición recoge el código -1 (CONCEPTO vacío)
+        hit[[i for i in candidates if q in self.lower[i]]] = True
+        return hit[self.codes]
+
+def sorted_positions(df, mask, sort_col=None, ascending=True):
+    # Posiciones (iloc) de las filas que cumplen mask, en orden estable por sort_col (None = orden original)
+    positions = np.flatnonzero(mask)
+    if sort_col is None or len(positions) == 0: return positions
+    keys = df[sort_col].iloc[positions].reset_index(drop=True)
+    if isinstance(keys.dtype, pd.CategoricalDtype): keys = keys.astype(object) # Orden alfabético, no el de las categorías
+    return positions[keys.sort_values(ascending=ascending, kind='stable', na_position='last').index.to_numpy()]
+
+# --- Ingesta: normalización del CSV y caché columnar (Parquet) por hash del archivo ---
+CATEGORICAL_COLS = ['CATEGORÍA', 'SUBCATEGORIA', 'CUENTA', 'TIPO', 'COMERCIO']
+INGEST_CACHE_DIR = os.environ.get('GASTOS_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.gastos_cache'))
+INGEST_CACHE_VERSION = 1 # Subir si cambia normalize_transactions para invalidar la caché
+
+def read_bank_csv(source, **kwargs):
+    return pd.read_csv(source, sep=';', encoding='utf-8', dtype={'AÑO': str, 'MES': str, 'DIA': str}, **kwargs)
+
+def normalize_transactions(df_processing, ph_cat='SIN CATEGORÍA', ph_sub='SIN SUBCATEGORÍA', categorical=True):
+    # Mismas reglas que el antiguo bloque de procesado de main(); devuelve (df, nº de filas con fecha inválida eliminadas)
+    df_processing.columns = df_processing.columns.str.strip()
+    imp_orig = 'IMPORTE'; tipo = 'TIPO'; cat = 'CATEGORÍA'; subcat = 'SUBCATEGORIA'; ano_col = 'AÑO'; mes_col = 'MES'; dia_col = 'DIA'; desc = 'CONCEPTO'; com = 'COMERCIO'; cta = 'CUENTA' # Nombres originales/claves
+    imp_calc = 'importe' # Nombre para cálculos
+    ano_calc = 'Año'; mes_calc = 'Mes' # Nombres para columnas calculadas
+    req_cols = [imp_orig, tipo, cat, subcat, ano_col, mes_col, dia_col, desc, com, cta];
+    missing = [c for c in req_cols if c not in df_processing.columns]; assert not missing, f"Faltan: {', '.join(missing)}"
+    df_processing.rename(columns={imp_orig: imp_calc}, inplace=True)
+    df_processing[imp_calc] = map_distinct(df_processing[imp_calc], lambda u: pd.to_numeric(u.astype(str).str.replace(',', '.', regex=False), errors='coerce').fillna(0).astype('float64'))
+    df_processing[ano_col] = map_distinct(df_processing[ano_col], lambda u: u.astype(str)); df_processing[mes_col] = map_distinct(df_processing[mes_col], lambda u: u.astype(str).str.zfill(2)); df_processing[dia_col] = map_distinct(df_processing[dia_col], lambda u: u.astype(str).str.zfill(2))
+    codes, fechas = factorize_rows(df_processing, [ano_col, mes_col, dia_col]) # Cada fecha distinta se parsea una sola vez
+    df_processing['Fecha'] = pd.to_datetime(fechas[ano_col] + '-' + fechas[mes_col] + '-' + fechas[dia_col], format='%Y-%m-%d', errors='coerce').to_numpy()[codes]
+    n_inv = int(df_processing['Fecha'].isnull().sum())
+    df_processing.dropna(subset=['Fecha'], inplace=True)
+    df_processing[ano_calc] = df_processing['Fecha'].dt.year.astype(int); df_processing[mes_calc] = df_processing['Fecha'].dt.month.astype(int) # Usar nombres calculados
+    fill_cols = {cat: ph_cat, subcat: ph_sub, com: '', cta: 'SIN CUENTA', tipo: 'SIN TIPO'}
+    for c, ph in fill_cols.items():
+         if c in df_processing.columns:
+               df_processing[c] = map_distinct(df_processing[c], lambda u: u.astype(str).replace(['nan', 'NaN', 'None', '<NA>'], pd.NA).fillna(ph))
+    mask_traspaso = df_processing[tipo] == 'TRASPASO'; df_processing.loc[mask_traspaso, cat] = 'TRASPASO'; df_processing.loc[mask_traspaso, subcat] = 'TRASPASO INTERNO'
+    mask_recibo = df_processing[tipo] == 'RECIBO'; df_processing.loc[mask_recibo, cat] = 'RECIBO'; df_processing.loc[mask_recibo, subcat] = 'PAGO RECIBO'
+    if categorical:
+        for c in CATEGORICAL_COLS: df_processing[c] = df_processing[c].astype('category')
+    return df_processing, n_inv
+
+def file_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+def ingest_cache_path(source_hash, cache_dir=INGEST_CACHE_DIR):
+    return os.path.join(cache_dir, f"{source_hash}.v{INGEST_CACHE_VERSION}.parquet")
+
+def load_transactions(data, cache_dir=INGEST_CACHE_DIR):
+    # Devuelve (df normalizado, hash, desde_caché, filas inválidas). Si el mismo contenido ya se procesó,
+    # se lee el Parquet cacheado con memory_map en lugar de volver a parsear y normalizar el CSV.
+    source_hash = file_hash(data); path = ingest_cache_path(source_hash, cache_dir)
+    if os.path.exists(path):
+        try:
+            with stage('lectura_cache_parquet') as rec: df = pd.read_parquet(path, memory_map=True); rec['rows'] = len(df)
+            return df, source_hash, True, int(df.attrs.get('filas_invalidas', 0))
+        except Exception: pass # Caché corrupta o ilegible: se regenera
+    with stage('lectura_csv') as rec: df_raw = read_bank_csv(io.BytesIO(data)); rec['rows'] = len(df_raw)
+    with stage('normalizacion', len(df_raw)): df, n_inv = normalize_transactions(df_raw)
+    df.attrs['filas_invalidas'] = n_inv # Se guarda en los metadatos del Parquet para avisar también al leer de caché
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with stage('escritura_cache_parquet', len(df)): df.to_parquet(tmp_path)
+        os.replace(tmp_path, path) # Escritura atómica: otras sesiones nunca ven un archivo a medias
+    except (OSError, ImportError, ValueError): # Sin caché (p.ej. sin pyarrow o sin permisos) la app sigue funcionando
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+    return df, source_hash, False, n_inv
+
+# --- Procesado por bloques (archivos muy grandes) ---
+# El CSV se lee con chunksize y cada bloque pasa por normalize_transactions: la memoria queda acotada por el tamaño
+# del bloque y del modelo aprendido, no por el del archivo.
+STREAM_CHUNK_ROWS = 100_000
+
+def iter_normalized_chunks(source, chunksize=STREAM_CHUNK_ROWS, ph_cat='SIN CATEGORÍA', ph_sub='SIN SUBCATEGORÍA'):
+    # source: ruta, bytes o archivo con seek (se rebobina, así que puede recorrerse varias veces), o una lista de ellos
+    # que se recorren en orden. Genera (bloque, filas inválidas)
+    for src in (source if isinstance(source, (list, tuple)) else [source]):
+        if isinstance(src, (bytes, bytearray)): src = io.BytesIO(src)
+        if hasattr(src, 'seek'): src.seek(0)
+        with read_bank_csv(src, chunksize=chunksize) as reader:
+            for chunk in reader: yield normalize_transactions(chunk, ph_cat, ph_sub, categorical=False)
+
+def _comercio_mode(counter):
+    # Igual que Series.mode()[0] en derive_comercio_map: la categoría más frecuente y, si empatan, la menor
+    top = max(counter.values()); return min(c for c, n in counter.items() if n == top)
+
+@instrumented('procesado_bloques', rows_arg=None)
+def process_csv_stream(source, output=None, chunksize=STREAM_CHUNK_ROWS, knowledge=None, comercio_map=None, hierarchy=None, suggest=True, on_chunk=None, ph_cat='SIN CATEGORÍA', ph_sub='SIN SUBCATEGORÍA'):
+    # Dos pasadas sobre el archivo, con el mismo resultado que procesarlo entero en main():
+    #   1) aprende el conocimiento (de cero, como learn_categories), el mapeo de comercios y la jerarquía;
+    #   2) sugiere las categorías que faltan, escribe el CSV categorizado en output y acumula el cubo de agregados.
+    # comercio_map/hierarchy (p.ej. los del almacén) prevalecen sobre lo derivado. on_chunk(fase, filas) informa del avance.
+    cat = 'CATEGORÍA'; subcat = 'SUBCATEGORIA'; desc = 'CONCEPTO'; com = 'COMERCIO'; imp = 'importe'
+    if knowledge is None: knowledge = new_category_knowledge()
+    knowledge.update(new_category_knowledge())
+    comercio_counts = defaultdict(Counter); derived_hierarchy = defaultdict(set); rows = invalid = 0
+    for chunk, n_inv in iter_normalized_chunks(source, chunksize, ph_cat, ph_sub):
+        update_category_knowledge(chunk[learnable_mask(chunk, cat, subcat, ph_cat, ph_sub)], desc, cat, subcat, imp, 1, knowledge)
+        for c, subs in derive_category_hierarchy(chunk, cat, subcat, ph_cat, ph_sub).items(): derived_hierarchy[c].update(subs)
+        valid = chunk[(chunk[com] != '') & (chunk[cat] != ph_cat)]
+        for (c, c_cat), n in valid.groupby([com, cat]).size().items(): comercio_counts[c][c_cat] += n
+        rows += len(chunk); invalid += n_inv
+        if on_chunk: on_chunk('aprendizaje', rows)
+    derived_map = {c: _comercio_mode(counts) for c, counts in comercio_counts.items()}; derived_map.update(comercio_map or {})
+    for c, subs in (hierarchy or {}).items(): derived_hierarchy[c].update(subs)
+    comercio_map, hierarchy = derived_map, derived_hierarchy
+
+    close_output = isinstance(output, (str, os.PathLike))
+    out = open(output, 'wb') if close_output else output # Archivo binario: los bloques se escriben ya codificados
+    cube = None; suggestions = done = 0; header_written = False
+    try:
+        for chunk, _ in iter_normalized_chunks(source, chunksize, ph_cat, ph_sub):
+            if suggest: suggestions += apply_category_suggestions(chunk, desc, imp, cat, subcat, com, ph_cat, ph_sub, comercio_map, hierarchy, knowledge)
+            part = build_aggregate_cube(chunk, imp); cube = part if cube is None else merge_aggregate_cubes([cube, part], imp)
+            if out is not None:
+                if not header_written: out.write(csv_header(export_frame(chunk.iloc[:0]).columns)); header_written = True # Un bloque entero puede quedar vacío (fechas inválidas)
+                out.write(csv_block(chunk))
+            done += len(chunk)
+            if on_chunk: on_chunk('categorización', done)
+    finally:
+        if close_output: out.close()
+    if cube is None: cube = pd.DataFrame(columns=CUBE_DIMS + [imp, 'n'])
+    return {'rows': rows, 'invalid_rows': invalid, 'suggestions': suggestions, 'cube': cube, 'knowledge': knowledge, 'comercio_map': comercio_map, 'hierarchy': hierarchy}
+
+# --- Almacén Persistente de Conocimiento (SQLite) ---
+# Guarda los contadores aprendidos, el mapeo Comercio -> Categoría y la jerarquía entre sesiones y reinicios.
+# 'comercios' sólo contiene los mapeos guardados a mano en Configuración: prevalecen sobre lo derivado de cada archivo,
+# así que nunca se guarda ahí lo derivado (un mapeo antiguo taparía lo que indica un archivo más reciente).
+# WAL + una conexión por operación permite que varias sesiones de Streamlit lean y escriban a la vez;
+# 'revision' se incrementa en cada escritura para que las demás sesiones sepan que deben recargar. Los contadores son la
+# instantánea de un único archivo ('source_hash') y sólo reciben deltas de ese archivo. Las etiquetas editadas se guardan
+# aparte por archivo ('ediciones') y se reaplican al volver a cargarlo: la instantánea nunca se usa con filas sin editar.
+KNOWLEDGE_DB_PATH = os.environ.get('GASTOS_KNOWLEDGE_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gastos_conocimiento.sqlite'))
+KNOWLEDGE_SCHEMA_VERSION = 3
+
+class KnowledgeStore:
+    def __init__(self, path=KNOWLEDGE_DB_PATH):
+        self.path = path
+        with closing(self._connect()) as conn, conn:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version > KNOWLEDGE_SCHEMA_VERSION: raise RuntimeError(f"Almacén de conocimiento con versión {version} no soportada (máx. {KNOWLEDGE_SCHEMA_VERSION}).")
+            if version < 1:
+                conn.executescript('''
+                    CREATE TABLE IF NOT EXISTS meta (clave TEXT PRIMARY KEY, valor TEXT);
+                    CREATE TABLE IF NOT EXISTS contadores (palabra TEXT NOT NULL, tramo INTEGER NOT NULL, categoria TEXT NOT NULL, subcategoria TEXT NOT NULL, n INTEGER NOT NULL,
+                                                           PRIMARY KEY (palabra, tramo, categoria, subcategoria));
+                    CREATE TABLE IF NOT EXISTS comercios (comercio TEXT PRIMARY KEY, categoria TEXT NOT NULL);
+                    CREATE TABLE IF NOT EXISTS jerarquia (categoria TEXT NOT NULL, subcategoria TEXT NOT NULL, PRIMARY KEY (categoria, subcategoria));
+                    INSERT OR IGNORE INTO meta VALUES ('revision', '0');
+                ''')
+            if version < 2:
+                # Las ediciones de una sesión anterior no se guardaban: sus deltas ya están en los contadores pero las filas no,
+                # así que la instantánea existente se descarta y se reaprende al volver a cargar el archivo
+                conn.executescript('''
+                    CREATE TABLE IF NOT EXISTS ediciones (source_hash TEXT NOT NULL, fila INTEGER NOT NULL, categoria TEXT, subcategoria TEXT, PRIMARY KEY (source_hash, fila));
+                    DELETE FROM contadores; DELETE FROM meta WHERE clave = 'source_hash';
+                ''')
+            if version < 3:
+                # kw_counter se guarda aparte, en su orden de inserción: reconstruirlo desde contadores (por tramo) cambia
+                # el orden de sus etiquetas y con él los empates. La instantánea anterior no lo tiene: se reaprende
+                conn.executescript('''
+                    CREATE TABLE IF NOT EXISTS palabras (palabra TEXT NOT NULL, categoria TEXT NOT NULL, subcategoria TEXT NOT NULL, n INTEGER NOT NULL,
+                                                         PRIMARY KEY (palabra, categoria, subcategoria));
+                    DELETE FROM contadores; DELETE FROM meta WHERE clave = 'source_hash';
+                ''')
+            if version < KNOWLEDGE_SCHEMA_VERSION: conn.execute(f'PRAGMA user_version = {KNOWLEDGE_SCHEMA_VERSION}')
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL'); conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _write(self, fn):
+        # Escritura atómica y serializada entre sesiones; devuelve la nueva revisión. Si fn devuelve False no se escribe nada
+        with closing(self._connect()) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if fn(conn) is False:
+                    conn.execute('ROLLBACK'); return self.revision()
+                conn.execute("UPDATE meta SET valor = CAST(valor AS INTEGER) + 1 WHERE clave = 'revision'")
+                revision = int(conn.execute("SELECT valor FROM meta WHERE clave = 'revision'").fetchone()[0])
+                conn.execute('COMMIT')
+            except BaseException: conn.execute('ROLLBACK'); raise
+        return revision
+
+    def _meta(self, key, default=None):
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT valor FROM meta WHERE clave = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def revision(self): return int(self._meta('revision', 0))
+    def source_hash(self): return self._meta('source_hash')
+
+    # --- Lectura ---
+    def load_knowledge(self):
+        # El rowid conserva el orden de inserción de cada etiqueta (las nuevas siempre van al final, como en los Counter)
+        knowledge = new_category_knowledge()
+        with closing(self._connect()) as conn:
+            kw_rows = conn.execute('SELECT palabra, categoria, subcategoria, n FROM palabras ORDER BY rowid').fetchall()
+            amt_rows = conn.execute('SELECT palabra, tramo, categoria, subcategoria, n FROM contadores ORDER BY rowid').fetchall()
+        kw_counter = knowledge["kw_counter"]; amt_counter = knowledge["amt_counter"]
+        for w, cat, sub, n in kw_rows: kw_counter.setdefault(w, Counter())[(cat, sub)] = n
+        for w, amt_bin, cat, sub, n in amt_rows: amt_counter.setdefault((w, amt_bin), Counter())[(cat, sub)] = n
+        knowledge["keyword_map"] = {w: c.most_common(1)[0][0] for w, c in kw_counter.items() if c}
+        knowledge["amount_map"] = {k: c.most_common(1)[0][0] for k, c in amt_counter.items() if c}
+        return knowledge
+
+    def load_edits(self, source_hash):
+        # Etiquetas editadas a mano en las filas de ese archivo: {fila: (categoria, subcategoria)}
+        with closing(self._connect()) as conn:
+            return {fila: (cat, sub) for fila, cat, sub in conn.execute('SELECT fila, categoria, subcategoria FROM ediciones WHERE source_hash = ? ORDER BY rowid', (source_hash,))}
+
+    def load_comercio_map(self):
+        with closing(self._connect()) as conn: return dict(conn.execute('SELECT comercio, categoria FROM comercios'))
+
+    def load_hierarchy(self):
+        hierarchy = defaultdict(set)
+        with closing(self._connect()) as conn:
+            for cat, sub in conn.execute('SELECT categoria, subcategoria FROM jerarquia'): hierarchy[cat].add(sub)
+        return hierarchy
+
+    # --- Escritura ---
+    def save_knowledge(self, knowledge, source_hash=None):
+        # Instantánea completa tras un aprendizaje completo, con las etiquetas de cada contador en su orden
+        kw_rows = [(w, str(cat), str(sub), int(n)) for w, c in knowledge["kw_counter"].items() for (cat, sub), n in c.items() if n > 0]
+        rows = [(w, int(amt_bin), str(cat), str(sub), int(n)) for (w, amt_bin), c in knowledge["amt_counter"].items() for (cat, sub), n in c.items() if n > 0]
+        def fn(conn):
+            conn.execute('DELETE FROM palabras'); conn.executemany('INSERT INTO palabras VALUES (?, ?, ?, ?)', kw_rows)
+            conn.execute('DELETE FROM contadores'); conn.executemany('INSERT INTO contadores VALUES (?, ?, ?, ?, ?)', rows)
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('source_hash', ?)", (source_hash,))
+        return self._write(fn)
+
+    def apply_knowledge_delta(self, deltas, source_hash=None, edits=None):
+        # deltas: lista de deltas de update_category_knowledge, aplicados en orden y con la misma poda de etiquetas a cero.
+        # edits ({fila: (categoria, subcategoria)}, las etiquetas nuevas) se guardan siempre bajo source_hash para reaplicarlas
+        # al cargar de nuevo el archivo. Los deltas sólo se suman si la instantánea guardada es de ese archivo (otra sesión pudo
+        # sustituirla por la de otro; al volver a cargar éste se reaprende con las ediciones ya aplicadas).
+        steps = []
+        for delta in deltas:
+            kw_delta = Counter()
+            for (w, _, cat, sub), n in delta.items(): kw_delta[(w, cat, sub)] += n # Mismo orden de primera aparición que en kw_counter
+            steps.append(([(w, str(cat), str(sub), int(n)) for (w, cat, sub), n in kw_delta.items() if n != 0],
+                          [(w, int(amt_bin), str(cat), str(sub), int(n)) for (w, amt_bin, cat, sub), n in delta.items() if n != 0]))
+        edit_rows = [(source_hash, int(fila), _label_or_none(cat), _label_or_none(sub)) for fila, (cat, sub) in (edits or {}).items()] if source_hash is not None else []
+        def fn(conn):
+            conn.executemany('INSERT OR REPLACE INTO ediciones VALUES (?, ?, ?, ?)', edit_rows)
+            if source_hash is not None and conn.execute("SELECT valor FROM meta WHERE clave = 'source_hash'").fetchone() != (source_hash,): return bool(edit_rows)
+            for kw_rows, rows in steps:
+                conn.executemany('''INSERT INTO palabras VALUES (?, ?, ?, ?)
+                                    ON CONFLICT (palabra, categoria, subcategoria) DO UPDATE SET n = n + excluded.n''', kw_rows)
+                conn.executemany('''INSERT INTO contadores VALUES (?, ?, ?, ?, ?)
+                                    ON CONFLICT (palabra, tramo, categoria, subcategoria) DO UPDATE SET n = n + excluded.n''', rows)
+                conn.execute('DELETE FROM palabras WHERE n <= 0'); conn.execute('DELETE FROM contadores WHERE n <= 0')
+        return self._write(fn)
+
+    def save_comercio_map(self, comercio_map, scope=None):
+        # Sólo escribe las diferencias con lo almacenado, leído en la misma transacción (no pisa lo que otra sesión acabe de guardar).
+        # scope: comercios que gestiona esta llamada; los guardados fuera de él se conservan (sin scope, comercio_map lo sustituye todo)
+        def fn(conn):
+            stored = dict(conn.execute('SELECT comercio, categoria FROM comercios'))
+            upserts = [(c, cat) for c, cat in comercio_map.items() if stored.get(c) != cat]
+            deletes = [(c,) for c in stored if c not in comercio_map and (scope is None or c in scope)]
+            if not upserts and not deletes: return False
+            conn.executemany('INSERT OR REPLACE INTO comercios VALUES (?, ?)', upserts); conn.executemany('DELETE FROM comercios WHERE comercio = ?', deletes)
+        return self._write(fn)
+
+    def save_hierarchy(self, hierarchy):
+        # Sólo añade pares: cada archivo aporta los suyos y ninguno borra los que vinieron de otros archivos
+        pairs = sorted({(str(cat), str(sub)) for cat, subs in hierarchy.items() for sub in subs})
+        def fn(conn):
+            before = conn.total_changes; conn.executemany('INSERT OR IGNORE INTO jerarquia VALUES (?, ?)', pairs)
+            return conn.total_changes > before # Sin pares nuevos no se escribe ni cambia la revisión
+        return self._write(fn)
+
+def _label_or_none(value):
+    return None if pd.isna(value) else str(value)
+
+def apply_stored_edits(df, store, source_hash, cat_col='CATEGORÍA', subcat_col='SUBCATEGORIA'):
+    # Reaplica en su sitio las ediciones guardadas de ese archivo; se llama al cargarlo, antes de aprender o de reutilizar
+    # su instantánea (que ya incluye sus deltas). Devuelve cuántas filas cambia.
+    edits = store.load_edits(source_hash) if store is not None and source_hash is not None else {}
+    index = df.index[df.index.isin(list(edits))]
+    if index.empty: return 0
+    return apply_row_edits(df, pd.DataFrame([edits[i] for i in index], index=index, columns=[cat_col, subcat_col]), [cat_col, subcat_col])
+
+# --- Exportación: CSV por bloques (con caché incremental), CSV comprimido, Parquet, XLSX y JSON ---
+EXPORT_FORMATS = { # formato -> (tipo MIME, extensión)
+    'csv': ('text/csv', 'csv'), 'csv.gz': ('application/gzip', 'csv.gz'), 'parquet': ('application/vnd.apache.parquet', 'parquet'),
+    'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'xlsx'), 'json': ('application/x-ndjson', 'json') }
+EXPORT_CHUNK_ROWS = 50_000
+EXPORT_GZIP_LEVEL = 1 # Compresión rápida: en 1M filas el nivel 6 tarda ~3.5x más para dejar el archivo en ~17% del CSV en vez de ~25%
+XLSX_MAX_ROWS = 1_048_575 # Límite de filas de una hoja de Excel (sin la cabecera)
+_CSV_SPECIAL = re.compile(r'[;"\r\n]') # Valores que pandas escribiría entre comillas
+
+def export_format_for(path):
+    name = os.path.basename(path).lower()
+    return 'csv.gz' if name.endswith('.csv.gz') else os.path.splitext(name)[1].lstrip('.') or 'csv'
+
+def csv_header(columns):
+    buf = io.StringIO(); csv.writer(buf, delimiter=';', lineterminator='\n').writerow(columns); return buf.getvalue().encode('utf-8')
+
+def _arrow_csv_rows(df_out):
+    # Escritura en C con pyarrow cuando el resultado es idéntico al de pandas: texto sin caracteres que necesiten comillas,
+    # enteros y fechas sin hora. Devuelve None en cualquier otro caso para que el bloque se escriba con pandas.
+    if pa is None: return None
+    arrays = []
+    for c in df_out.columns:
+        s = df_out[c]
+        if s.dtype == object or isinstance(s.dtype, pd.CategoricalDtype):
+            codes, uniques = pd.factorize(s)
+            uniques = pd.Series(np.asarray(uniques, dtype=object))
+            if not all(isinstance(v, str) for v in uniques) or uniques.str.contains(_CSV_SPECIAL).any(): return None
+            arrays.append(pa.DictionaryArray.from_arrays(pa.array(codes, mask=codes < 0), pa.array(uniques.tolist(), pa.string())).cast(pa.string()))
+        elif pd.api.types.is_integer_dtype(s) and not pd.api.types.is_bool_dtype(s): arrays.append(pa.array(s.to_numpy()))
+        elif pd.api.types.is_datetime64_dtype(s):
+            if not (s.dropna().dt.normalize() == s.dropna()).all(): return None # Con horas pandas cambia de formato
+            arrays.append(pa.array(map_distinct(s, lambda u: pd.to_datetime(u).dt.strftime('%Y-%m-%d')).to_numpy(dtype=object), pa.string(), from_pandas=True))
+        else: return None
+    buf = io.BytesIO()
+    pa_csv.write_csv(pa.Table.from_arrays(arrays, names=[str(c) for c in df_out.columns]), buf, pa_csv.WriteOptions(include_header=False, delimiter=';', quoting_style='none'))
+    return buf.getvalue()
+
+def csv_block(df_chunk):
+    # Filas de un bloque (sin cabecera) en el formato de descarga de la app
+    df_out = export_frame(df_chunk)
+    data = _arrow_csv_rows(df_out)
+    return data if data is not None else df_out.to_csv(index=False, header=False, sep=';', decimal=',').encode('utf-8')
+
+def iter_csv_blocks(df, chunksize=EXPORT_CHUNK_ROWS):
+    # Cabecera y después un bloque de bytes por cada chunksize filas: nunca se construye el CSV entero como un único texto
+    yield csv_header(export_frame(df.iloc[:0]).columns)
+    for start in range(0, len(df), chunksize): yield csv_block(df.iloc[start:start + chunksize])
+
+def _typed_export_frame(df):
+    # Parquet/XLSX/JSON conservan los tipos (importe numérico, Fecha); sólo se quitan las columnas auxiliares del editor
+    return df.drop(columns=['original_index', 'temp_id'], errors='ignore')
+
+@instrumented('exportacion')
+def write_export(df, dest, fmt='csv', chunksize=EXPORT_CHUNK_ROWS):
+    # dest: ruta o archivo binario abierto. Los CSV se escriben por bloques; .csv.gz se comprime al vuelo.
+    if fmt not in EXPORT_FORMATS: raise ValueError(f"Formato de salida no soportado: {fmt} (usa {', '.join(EXPORT_FORMATS)})")
+    if fmt == 'xlsx' and len(df) > XLSX_MAX_ROWS: raise ValueError(f"Excel admite como máximo {XLSX_MAX_ROWS:,} filas; usa CSV o Parquet")
+    close_dest = isinstance(dest, (str, os.PathLike))
+    out = open(dest, 'wb') if close_dest else dest
+    try:
+        if fmt in ('csv', 'csv.gz'):
+            target = gzip.GzipFile(fileobj=out, mode="wb", compresslevel=EXPORT_GZIP_LEVEL, mtime=0) if fmt == 'csv.gz' else out
+            for block in iter_csv_blocks(df, chunksize): target.write(block)
+            if target is not out: target.close()
+        elif fmt == 'parquet': _typed_export_frame(df).to_parquet(out)
+        elif fmt == 'json': out.write(_typed_export_frame(df).to_json(orient='records', lines=True, date_format='iso', force_ascii=False).encode('utf-8'))
+        else:
+            try: _typed_export_frame(df).to_excel(out, index=False, sheet_name='Gastos')
+            except ImportError as e: raise ValueError(f"La exportación a Excel necesita openpyxl ({e})") from e
+    finally:
+        if close_dest: out.close()
+
+class ExportCache:
+    # Descargas de la sesión sin hashear el DataFrame: el archivo se genera sólo cuando se pide y no se guarda entero
+    # (sería una segunda copia de los datos en la sesión). Los CSV se guardan por bloques de filas, así que tras editar
+    # unas filas sólo se regeneran sus bloques y volver a pedirlo sólo los concatena.
+    def __init__(self, chunksize=EXPORT_CHUNK_ROWS):
+        self.chunksize = chunksize; self.n_rows = None; self.blocks = {}
+
+    def invalidate(self, df=None, index=None):
+        # Sin índice se descarta todo (archivo nuevo); con las etiquetas de las filas cambiadas, sólo sus bloques
+        if index is None or df is None: self.blocks.clear(); return
+        pos = df.index.get_indexer(index)
+        for b in set((pos[pos >= 0] // self.chunksize).tolist()):
+            for fmt_blocks in self.blocks.values(): fmt_blocks.pop(b, None)
+
+    def render(self, df, fmt='csv'):
+        # Devuelve los bytes del archivo en el formato pedido para los datos actuales
+        with stage(f'exportacion_{fmt}', len(df)): return self._render(df, fmt)
+
+    def _render(self, df, fmt):
+        if self.n_rows != len(df): self.blocks.clear(); self.n_rows = len(df)
+        if fmt in ('csv', 'csv.gz'):
+            blocks = self.blocks.setdefault(fmt, {}); pack = (lambda b: gzip.compress(b, compresslevel=EXPORT_GZIP_LEVEL, mtime=0)) if fmt == 'csv.gz' else (lambda b: b)
+            if 'header' not in blocks: blocks['header'] = pack(csv_header(export_frame(df.iloc[:0]).columns))
+            for b in range(-(-len(df) // self.chunksize)):
+                if b not in blocks: blocks[b] = pack(csv_block(df.iloc[b * self.chunksize:(b + 1) * self.chunksize]))
+            data = b''.join([blocks['header']] + [blocks[b] for b in range(-(-len(df) // self.chunksize))]) # Varios miembros gzip concatenados son un .gz válido
+        else:
+            buf = io.BytesIO(); write_export(df, buf, fmt, self.chunksize); data = buf.getvalue()
+        return data
+
+# --- Categorización en paralelo (pool de procesos) ---
+# Se reparte por fragmentos contiguos de filas (con varios archivos, cada uno ocupa un tramo contiguo tras load_files)
+# y los resultados se juntan en el orden de los fragmentos, así que la salida es idéntica a la del proceso único.
+_worker_state = {}
+
+def row_shards(df, n_shards):
+    bounds = np.linspace(0, len(df), max(1, min(n_shards, len(df))) + 1).astype(int)
+    return [df.iloc[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+
+def _learn_shard(shard, cols):
+    knowledge = new_category_knowledge(); update_category_knowledge(shard, *cols, 1, knowledge)
+    return knowledge['kw_counter'], knowledge['amt_counter']
+
+def merge_knowledge_counters(knowledge, parts):
+    # Suma los contadores parciales en el orden de los fragmentos: el orden de inserción de las etiquetas
+    # (y por tanto los desempates de most_common) es el mismo que si se hubieran contado en serie.
+    touched_kw = set(); touched_amt = set()
+    for kw_part, amt_part in parts:
+        for k, c in kw_part.items(): knowledge['kw_counter'].setdefault(k, Counter()).update(c); touched_kw.add(k)
+        for k, c in amt_part.items(): knowledge['amt_counter'].setdefault(k, Counter()).update(c); touched_amt.add(k)
+    _refresh_argmax(knowledge['kw_counter'], knowledge['keyword_map'], touched_kw)
+    _refresh_argmax(knowledge['amt_counter'], knowledge['amount_map'], touched_amt)
+    return knowledge
+
+def knowledge_snapshot(knowledge, comercio_map, hierarchy, rule_matcher):
+    # Copia de sólo lectura que se envía una vez a cada proceso: sólo los argmax (no los contadores) y la tabla de reglas.
+    # La subcategoría por defecto de cada categoría se fija aquí, porque el orden de un set depende de la semilla de hash del proceso.
+    return {'knowledge': {'keyword_map': knowledge['keyword_map'], 'amount_map': knowledge['amount_map'], 'kw_counter': {}, 'amt_counter': {}},
+            'comercio_map': dict(comercio_map or {}), 'hierarchy': {c: [next(iter(subs), '')] for c, subs in (hierarchy or {}).items()}, 'rules': rule_matcher.rules}
+
+def _init_suggestion_worker(snapshot):
+    _worker_state.clear(); _worker_state.update(snapshot); _worker_state['rule_matcher'] = RuleMatcher(_worker_state.pop('rules'))
+
+def _suggest_shard(shard, cols):
+    state = _worker_state
+    return suggest_categories_batch(shard, *cols, state['comercio_map'], state['hierarchy'], state['knowledge'], state['rule_matcher'])
+
+class SuggestionPool:
+    # Pool de procesos con el modelo ya cargado; suggest() devuelve lo mismo que suggest_categories_batch
+    def __init__(self, workers, knowledge=None, comercio_map=None, hierarchy=None, rule_matcher=None):
+        self.workers = workers
+        snapshot = knowledge_snapshot(category_knowledge if knowledge is None else knowledge, comercio_map, hierarchy, rule_matcher or get_rule_matcher())
+        self.executor = ProcessPoolExecutor(workers, initializer=_init_suggestion_worker, initargs=(snapshot,))
+
+    def suggest(self, df, concepto_col, importe_col, cat_col, subcat_col, com_col):
+        cols = [concepto_col, importe_col, cat_col, subcat_col, com_col]
+        parts = list(self.executor.map(functools.partial(_suggest_shard, cols=cols), row_shards(df[cols], self.workers)))
+        return pd.concat(parts) if parts else pd.DataFrame({cat_col: [], subcat_col: []}, index=df.index, dtype=object)
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self): return self
+    def __exit__(self, *exc): self.close()
+
+def _load_path(path, cache_dir):
+    with open(path, 'rb') as f: return load_transactions(f.read(), cache_dir)
+
+# --- Procesado sin interfaz (línea de comandos / lotes) ---
+OUTPUT_FORMATS = tuple(EXPORT_FORMATS)
+
+def load_files(paths, cache_dir=INGEST_CACHE_DIR, workers=1):
+    # Carga y normaliza uno o varios extractos (con la caché Parquet), un archivo por proceso si workers > 1.
+    # Devuelve (df, hash del conjunto, filas inválidas)
+    frames = []; hashes = []; invalid = 0
+    if workers > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(min(workers, len(paths))) as executor: loaded = list(executor.map(_load_path, paths, [cache_dir] * len(paths)))
+    else: loaded = [_load_path(path, cache_dir) for path in paths]
+    for df, source_hash, _, n_inv in loaded:
+        frames.append(df); hashes.append(source_hash); invalid += n_inv
+    if len(frames) == 1: return frames[0], hashes[0], invalid # Mismo hash que al subir el archivo en la app
+    df = pd.concat(frames, ignore_index=True)
+    for c in CATEGORICAL_COLS: df[c] = df[c].astype('category') # concat de categóricas distintas da object
+    return df, file_hash(''.join(hashes).encode()), invalid
+
+@instrumented('categorizacion')
+def categorize_frame(df, knowledge=None, comercio_map=None, hierarchy=None, learn=True, suggest=True, ph_cat='SIN CATEGORÍA', ph_sub='SIN SUBCATEGORÍA', workers=1):
+    # Mismo recorrido que el procesado de main() y el botón de sugerencias, sobre df en su sitio.
+    # comercio_map/hierarchy (p.ej. los del almacén) prevalecen sobre lo derivado; learn=False reutiliza knowledge tal cual.
+    # Con workers > 1 el aprendizaje y las sugerencias se reparten en un pool de procesos (mismo resultado).
+    cat = 'CATEGORÍA'; subcat = 'SUBCATEGORIA'; desc = 'CONCEPTO'; com = 'COMERCIO'; imp = 'importe'
+    if knowledge is None: knowledge = new_category_knowledge()
+    derived_hierarchy = derive_category_hierarchy(df, cat, subcat, ph_cat, ph_sub); derived_map = derive_comercio_map(df, com, cat, ph_cat)
+    derived_map.update(comercio_map or {})
+    for c, subs in (hierarchy or {}).items(): derived_hierarchy[c].update(subs)
+    if learn and workers > 1:
+        with ProcessPoolExecutor(workers) as executor: learn_categories(df, desc, cat, subcat, imp, ph_cat, ph_sub, knowledge, executor, workers)
+    elif learn: learn_categories(df, desc, cat, subcat, imp, ph_cat, ph_sub, knowledge)
+    suggestions = 0
+    if suggest and workers > 1:
+        with SuggestionPool(workers, knowledge, derived_map, derived_hierarchy) as pool: suggestions = apply_category_suggestions(df, desc, imp, cat, subcat, com, ph_cat, ph_sub, pool=pool)
+    elif suggest: suggestions = apply_category_suggestions(df, desc, imp, cat, subcat, com, ph_cat, ph_sub, derived_map, derived_hierarchy, knowledge)
+    return {'rows': len(df), 'suggestions': suggestions, 'cube': build_aggregate_cube(df, imp), 'knowledge': knowledge, 'comercio_map': derived_map, 'hierarchy': derived_hierarchy}
+
+def write_output(df, path, fmt=None):
+    # csv/csv.gz: el mismo formato que la descarga de la app; parquet/xlsx/json conservan los tipos (importe numérico, Fecha)
+    write_export(df, path, fmt or export_format_for(path))
+
+def open_model_store(model):
+    # --model: 'none' (sólo en memoria), 'store' (almacén por defecto) o la ruta de un archivo SQLite
+    if model == 'none': return None
+    return KnowledgeStore(KNOWLEDGE_DB_PATH if model == 'store' else model)
+
+def run_categorize(args):
+    t0 = time.perf_counter()
+    store = open_model_store(args.model)
+    comercio_map = store.load_comercio_map() if store is not None else {}
+    hierarchy = store.load_hierarchy() if store is not None else {}
+    if args.chunksize:
+        fmt = args.format or export_format_for(args.output)
+        if fmt != 'csv': raise ValueError("El modo por bloques (--chunksize) sólo escribe CSV")
+        result = process_csv_stream(list(args.inputs), args.output, args.chunksize, comercio_map=comercio_map, hierarchy=hierarchy, suggest=not args.no_suggest)
+        source_hash = None; learned = False
+    else:
+        workers = args.workers or os.cpu_count() or 1
+        df, source_hash, invalid = load_files(args.inputs, workers=workers)
+        if store is not None: apply_stored_edits(df, store, source_hash) # Las ediciones hechas en la app sobre este mismo archivo
+        learned = store is not None and store.source_hash() == source_hash # Modelo ya aprendido de estos mismos archivos
+        result = categorize_frame(df, store.load_knowledge() if learned else None, comercio_map, hierarchy, learn=not learned, suggest=not args.no_suggest, workers=workers)
+        result['invalid_rows'] = invalid
+        write_output(df, args.output, args.format)
+    if args.aggregates: result['cube'].to_csv(args.aggregates, index=False, sep=';', decimal=',', encoding='utf-8')
+    if store is not None:
+        if not args.chunksize and not learned: store.save_knowledge(result['knowledge'], source_hash) # Por bloques no hay hash del archivo: se conserva la instantánea guardada
+        store.save_hierarchy(result['hierarchy']) # El mapeo de comercios derivado no se guarda: sólo los mapeos de Configuración
+    print(f"{result['rows']} filas ({result['invalid_rows']} con fecha inválida eliminadas), {result['suggestions']} categorías sugeridas -> {args.output} en {time.perf_counter() - t0:.2f} s")
+    return 0
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(prog='gastos_familiares_core', description="Procesado de extractos bancarios sin interfaz.")
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('categorize', help="Normaliza, aprende, sugiere categorías y exporta uno o varios extractos.")
+    p.add_argument('inputs', nargs='+', help="CSV del banco (separador ';'); varios archivos se procesan como un único conjunto")
+    p.add_argument('-o', '--output', required=True, help="Archivo de salida")
+    p.add_argument('-f', '--format', choices=OUTPUT_FORMATS, help="Formato de salida (por defecto, según la extensión)")
+    p.add_argument('--model', default='none', help="none (en memoria), store (almacén de conocimiento por defecto) o ruta a un .sqlite")
+    p.add_argument('--aggregates', help="Escribe también el cubo de agregados en este CSV")
+    p.add_argument('--chunksize', type=int, help="Procesa por bloques de este nº de filas (memoria acotada; sólo salida CSV)")
+    p.add_argument('-j', '--workers', type=int, default=1, help="Procesos para cargar archivos, aprender y sugerir (0 = todos los núcleos)")
+    p.add_argument('--no-suggest', action='store_true', help="No sugerir categorías; sólo normalizar y exportar")
+    p.set_defaults(func=run_categorize)
+    return parser
+
+CLI_COMMANDS = ('categorize',)
+
+def cli(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    try: return args.func(args)
+    except (OSError, ValueError, AssertionError, RuntimeError, sqlite3.Error) as e:
+        print(f"Error: {e}", file=sys.stderr); return 1
+
+if __name__ == "__main__":
+    sys.exit(cli())